@@ -0,0 +1,104 @@
+import hashlib
+
+from typing import Collection, Optional
+
+
+class BloomFilter:
+    """Bloom filter over string keys
+
+    Answers "definitely absent" or "possibly present" for a key. Used to skip loading a bucket for keys it cannot contain
+    """
+
+    HASHES_COUNT = 3
+    BITS_PER_KEY = 8
+    MIN_SIZE = 1024
+
+    def __init__(self, size: int = MIN_SIZE, bits: Optional[bytearray] = None):
+        """Initialize the bloom filter
+
+        Args:
+            size (int): The number of bits, must be a power of two (default: 1024)
+            bits (bytearray, optional): The initial bit set, bit i is bit i % 8 of byte i // 8 (default: None, empty filter)
+
+        Note:
+            The bits are kept in a bytearray, so adding a key and probing it only touch the bytes of its positions
+        """
+
+        self.size = size
+        self.bits = bits if bits is not None else bytearray(size // 8)
+
+    @classmethod
+    def from_keys(cls, keys: Collection[str]) -> "BloomFilter":
+        """Create a bloom filter sized for a collection of keys
+
+        Args:
+            keys (Collection[str]): The keys to add
+
+        Returns:
+            BloomFilter: Filter containing all the keys
+        """
+
+        size = cls.MIN_SIZE
+        while size < len(keys) * cls.BITS_PER_KEY:
+            size <<= 1
+
+        bloom = cls(size)
+        for key in keys:
+            bloom.add(key)
+        return bloom
+
+    def _positions(self, key: str) -> list[int]:
+        """Get the bit positions of a key
+
+        Args:
+            key (str): The key
+
+        Returns:
+            list[int]: Bit positions derived from a 64-bit BLAKE2b digest by double hashing
+        """
+
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+        h1 = int.from_bytes(digest[:4], "little")
+        h2 = int.from_bytes(digest[4:], "little") | 1
+        mask = self.size - 1
+        return [(h1 + i * h2) & mask for i in range(self.HASHES_COUNT)]
+
+    def add(self, key: str) -> None:
+        """Add a key to the filter
+
+        Args:
+            key (str): The key to add
+        """
+
+        bits = self.bits
+        for position in self._positions(key):
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def might_contain(self, key: str) -> bool:
+        """Check whether a key may have been added
+
+        Args:
+            key (str): The key to check
+
+        Returns:
+            bool: False if the key was definitely never added, True otherwise
+        """
+
+        bits = self.bits
+        return all(
+            bits[position >> 3] >> (position & 7) & 1
+            for position in self._positions(key)
+        )
+
+    def to_dict(self) -> dict:
+        """Convert the filter to a dictionary for storage"""
+        # Stored as the hex form of the bit set read as one little-endian integer
+        bits = int.from_bytes(self.bits, "little")
+        return {"size": self.size, "bits": format(bits, "x")}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "BloomFilter":
+        """Create a filter from dictionary"""
+        size = data["size"]
+        bits = int(data["bits"], 16).to_bytes(size // 8, "little")
+        return cls(size=size, bits=bytearray(bits))
@@ -1,12 +1,22 @@
 import argparse
+import importlib
+from typing import Optional
 from kvstorage.storage import KVStorage
-from requests.set_request import SetRequest
-from requests.get_request import GetRequest
-from requests.delete_request import DeleteRequest
 
+# Request classes are imported on demand, a single invocation only needs one of them
+COMMAND_MAP = {
+    "get": ("kvstorage.requests.get_request", "GetRequest"),
+    "set": ("kvstorage.requests.set_request", "SetRequest"),
+    "delete": ("kvstorage.requests.delete_request", "DeleteRequest"),
+}
 
-def main():
-    """Entry point for the KVStorage CLI"""
+
+def main(argv: Optional[list[str]] = None) -> None:
+    """Entry point for the KVStorage CLI
+
+    Args:
+        argv (Optional[list[str]]): Command line arguments without the program name (default: sys.argv[1:])
+    """
 
     parser = argparse.ArgumentParser(
         prog="KV-Storage",
@@ -17,7 +27,7 @@ def main():
     parser.add_argument("storage", help="Name of the storage to use")
     parser.add_argument(
         "command",
-        choices=["get", "set", "delete"],
+        choices=list(COMMAND_MAP),
         help="Command to execute on the storage",
     )
     parser.add_argument(
@@ -30,20 +40,15 @@ def main():
         help="Print detailed output (default: no output)",
     )
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     storage = KVStorage(storage_name=args.storage)
     command = args.command
 
-    command_map = {
-        "set": SetRequest,
-        "get": GetRequest,
-        "delete": DeleteRequest,
-    }
-
-    request_class = command_map[command]
-    request = request_class(args, storage)
-    request.execute()
+    module_name, class_name = COMMAND_MAP[command]
+    request_class = getattr(importlib.import_module(module_name), class_name)
+    with storage:
+        request_class(args, storage).execute()
 
 
 if __name__ == "__main__":
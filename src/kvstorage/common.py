@@ -0,0 +1,144 @@
+import functools
+import json
+import math
+import re
+
+from typing import Any
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson reads integers outside the 64-bit range as floats, documents with a run of 19 or more digits are parsed by the json module
+WIDE_NUMBER_PATTERN = re.compile(rb"\d{19}")
+
+
+def _has_non_finite_float(obj: Any) -> bool:
+    """Check whether an object contains NaN or an infinite float
+
+    Args:
+        obj (any): The object to check
+
+    Returns:
+        bool: True if a float anywhere in the object is not finite
+    """
+
+    if isinstance(obj, float):
+        return not math.isfinite(obj)
+    if isinstance(obj, dict):
+        return any(_has_non_finite_float(value) for value in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(_has_non_finite_float(item) for item in obj)
+    return False
+
+
+def encode_json(obj: Any) -> bytes:
+    """Serialize an object to compact JSON
+
+    Args:
+        obj (any): The object to serialize
+
+    Returns:
+        bytes: UTF-8 encoded JSON document
+
+    Raises:
+        TypeError: If the object cannot be serialized
+        ValueError: If the object cannot be serialized
+
+    Note:
+        Uses orjson when it is installed (kvstorage[fast]) and falls back to the standard json module for values orjson does not support (e.g. integers wider than 64 bits) or would change: orjson writes NaN and infinite floats as null, the json module keeps them as NaN and Infinity
+    """
+
+    if orjson is not None:
+        try:
+            data = orjson.dumps(obj)
+        except orjson.JSONEncodeError:
+            pass
+        else:
+            # Non-finite floats are rare, the object is only searched for them when the output has a null
+            if b"null" not in data or not _has_non_finite_float(obj):
+                return data
+
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def decode_json(data) -> Any:
+    """Deserialize a document produced by encode_json
+
+    Args:
+        data (bytes | memoryview): UTF-8 encoded JSON document
+
+    Returns:
+        any: The deserialized object
+
+    Raises:
+        json.JSONDecodeError: If the data is not valid JSON
+
+    Note:
+        Documents written by the json module fallback are read back by the json module as well: orjson rejects NaN and Infinity and reads wide integers as floats
+    """
+
+    if orjson is not None and not WIDE_NUMBER_PATTERN.search(data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    return json.loads(data)
+
+
+def validate_key(key: str) -> None:
+    """Validate a key before it is written
+
+    Args:
+        key (str): The key to validate
+
+    Raises:
+        ValueError: If the key is empty, whitespace, or not a string
+    """
+
+    if not isinstance(key, str):
+        raise ValueError("Key must be a string")
+
+    if not key or key.isspace():
+        raise ValueError("Invalid key")
+
+
+def encode_value(value: Any) -> bytes:
+    """Serialize a value before it is written
+
+    Args:
+        value (any): The value to serialize
+
+    Returns:
+        bytes: UTF-8 encoded JSON document
+
+    Raises:
+        ValueError: If the value cannot be encoded as JSON
+    """
+
+    try:
+        return encode_json(value)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Value cannot be stored: {e}") from e
+
+
+def synchronized(method):
+    """Run a storage method while holding the storage lock
+
+    Args:
+        method (callable): The method to wrap, its instance must have a _lock attribute
+
+    Returns:
+        callable: The wrapped method
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
@@ -8,13 +8,14 @@ class DeleteRequest(BaseRequest):
         if len(items) < 1:
             raise ValueError("Invalid arguments: at least one key is required")
 
-        self.keys = items
+        # A key given twice is deleted and reported once
+        self.keys = list(dict.fromkeys(items))
 
     def execute(self):
-        for key in self.keys:
-            value = self.storage.delete(key)
+        deleted = self.storage.delete_many(self.keys)
 
-            if value is not None:
+        for key in self.keys:
+            if key in deleted:
                 if self.args.verbose:
                     print(f"'{key}' was deleted")
             else:
@@ -13,7 +13,8 @@ class SetRequest(BaseRequest):
         self.pairs = [item.split("=", 1) for item in items]
 
     def execute(self):
-        for key, value in self.pairs:
-            self.storage.set(key, value)
-            if self.args.verbose:
+        self.storage.set_many(self.pairs)
+
+        if self.args.verbose:
+            for key, value in self.pairs:
                 print(f"Set {key} = {value}")
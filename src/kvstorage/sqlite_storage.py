@@ -0,0 +1,375 @@
+import os
+import sqlite3
+import threading
+
+from typing import Any, Iterable, Iterator, Optional
+
+from .common import decode_json, encode_value, synchronized, validate_key
+from .storage import KeyNotFoundError
+
+
+class SQLiteKVStorage:
+    """Key-value storage backed by SQLite
+
+    Offers the same interface as KVStorage but keeps all pairs in a single SQLite database in WAL mode, so a write only touches the pages of the changed key instead of rewriting a whole bucket file
+
+    Modifications are written in an open transaction and committed when flush() is called
+
+    Public methods are thread-safe, they are serialized by a storage-wide lock
+    """
+
+    DATABASE_NAME = "storage.db"
+
+    # Number of pairs read per lock acquisition by iter_items()
+    ITER_PAGE_SIZE = 1024
+
+    def __init__(self, storage_name="kvstorage"):
+        """Initialize the key-value storage
+
+        Args:
+            storage_name (str): The name of the storage directory (default: "kvstorage")
+
+        Raises:
+            ValueError: If storage_name is empty/whitespace
+            FileExistsError: If storage_name exists and is not a directory
+        """
+
+        if not storage_name or not storage_name.strip():
+            raise ValueError("Invalid storage name")
+
+        self._lock = threading.RLock()
+        self.storage_name = storage_name
+
+        if os.path.exists(self.storage_name) and not os.path.isdir(self.storage_name):
+            raise FileExistsError(f"{self.storage_name} exists and is not a directory")
+        os.makedirs(self.storage_name, exist_ok=True)
+
+        self.connection = sqlite3.connect(
+            os.path.join(self.storage_name, self.DATABASE_NAME),
+            check_same_thread=False,
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS items (key TEXT PRIMARY KEY, value BLOB NOT NULL) WITHOUT ROWID"
+        )
+        self.connection.commit()
+
+    def _select(self, key: str) -> tuple[bool, Any]:
+        """Look up a key
+
+        Args:
+            key (str): The key to look up
+
+        Returns:
+            tuple[bool, any]: Whether the key exists and its value (None if not found)
+        """
+
+        row = self.connection.execute(
+            "SELECT value FROM items WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return False, None
+        return True, decode_json(row[0])
+
+    @synchronized
+    def set(self, key: str, value: Any) -> None:
+        """Set a key-value pair in the storage
+
+        Args:
+            key (str): The key to set
+            value (any): The value to set
+
+        Raises:
+            ValueError: If the key is empty, whitespace, or not a string, or the value cannot be encoded as JSON
+
+        Note:
+            The change is persisted on flush()
+        """
+
+        validate_key(key)
+        self.connection.execute(
+            "INSERT OR REPLACE INTO items (key, value) VALUES (?, ?)",
+            (key, encode_value(value)),
+        )
+
+    @synchronized
+    def get(self, key: str) -> Any:
+        """Get a value from the storage
+
+        Args:
+            key (str): The key to get
+
+        Returns:
+            any: Value associated with the key
+
+        Raises:
+            KeyNotFoundError: If the key does not exist
+        """
+
+        found, value = self._select(key)
+        if not found:
+            raise KeyNotFoundError("Key not found")
+        return value
+
+    @synchronized
+    def delete(self, key: str) -> Any:
+        """Delete a key-value pair from the storage
+
+        Args:
+            key (str): The key to delete
+
+        Returns:
+            any: Value associated with the key (None if not found)
+        """
+
+        return self.pop(key)[1]
+
+    @synchronized
+    def pop(self, key: str) -> tuple[bool, Any]:
+        """Delete a key-value pair and report whether it existed
+
+        Args:
+            key (str): The key to delete
+
+        Returns:
+            tuple[bool, any]: Whether the key existed and its value (None if not found)
+        """
+
+        found, value = self._select(key)
+        if found:
+            self.connection.execute("DELETE FROM items WHERE key = ?", (key,))
+        return found, value
+
+    @synchronized
+    def set_if_absent(self, key: str, value: Any) -> bool:
+        """Set a key-value pair only if the key does not exist yet
+
+        Args:
+            key (str): The key to set
+            value (any): The value to set
+
+        Returns:
+            bool: True if the pair was set, False if the key already exists
+
+        Raises:
+            ValueError: If the key is empty, whitespace, or not a string, or the value cannot be encoded as JSON
+        """
+
+        validate_key(key)
+        cursor = self.connection.execute(
+            "INSERT OR IGNORE INTO items (key, value) VALUES (?, ?)",
+            (key, encode_value(value)),
+        )
+        return cursor.rowcount == 1
+
+    @synchronized
+    def set_if_exists(self, key: str, value: Any) -> bool:
+        """Replace the value of a key only if the key already exists
+
+        Args:
+            key (str): The key to set
+            value (any): The value to set
+
+        Returns:
+            bool: True if the value was replaced, False if the key does not exist
+
+        Raises:
+            ValueError: If the value cannot be encoded as JSON
+        """
+
+        cursor = self.connection.execute(
+            "UPDATE items SET value = ? WHERE key = ?", (encode_value(value), key)
+        )
+        return cursor.rowcount == 1
+
+    @synchronized
+    def set_many(self, pairs: Iterable[tuple[str, Any]]) -> None:
+        """Set multiple key-value pairs
+
+        Args:
+            pairs (Iterable[tuple[str, any]]): The key-value pairs to set
+
+        Raises:
+            ValueError: If any key is empty, whitespace, or not a string, or any value cannot be encoded as JSON (nothing is set in that case)
+        """
+
+        rows = []
+        for key, value in dict(pairs).items():
+            validate_key(key)
+            rows.append((key, encode_value(value)))
+
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO items (key, value) VALUES (?, ?)", rows
+        )
+
+    @synchronized
+    def get_many(self, keys: Iterable[str]) -> dict[str, Any]:
+        """Get multiple values
+
+        Args:
+            keys (Iterable[str]): The keys to get
+
+        Returns:
+            dict[str, any]: Values of the keys that exist in the storage
+        """
+
+        values = {}
+        for key in keys:
+            found, value = self._select(key)
+            if found:
+                values[key] = value
+        return values
+
+    @synchronized
+    def delete_many(self, keys: Iterable[str]) -> dict[str, Any]:
+        """Delete multiple keys
+
+        Args:
+            keys (Iterable[str]): The keys to delete
+
+        Returns:
+            dict[str, any]: Values of the keys that were deleted
+        """
+
+        deleted = {}
+        for key in keys:
+            found, value = self.pop(key)
+            if found:
+                deleted[key] = value
+        return deleted
+
+    @synchronized
+    def keys(self) -> list[str]:
+        """Get all keys in the storage
+
+        Returns:
+            list[str]: List of all keys in the storage
+        """
+
+        return [row[0] for row in self.connection.execute("SELECT key FROM items")]
+
+    @synchronized
+    def _items_page(self, after: Optional[str]) -> list[tuple[str, Any]]:
+        """Get the key-value pairs that follow a key in key order
+
+        Args:
+            after (Optional[str]): The last key of the previous page (None for the first page)
+
+        Returns:
+            list[tuple[str, Any]]: Up to ITER_PAGE_SIZE key-value pairs
+        """
+
+        if after is None:
+            rows = self.connection.execute(
+                "SELECT key, value FROM items ORDER BY key LIMIT ?",
+                (self.ITER_PAGE_SIZE,),
+            )
+        else:
+            rows = self.connection.execute(
+                "SELECT key, value FROM items WHERE key > ? ORDER BY key LIMIT ?",
+                (after, self.ITER_PAGE_SIZE),
+            )
+        return [(key, decode_json(value)) for key, value in rows]
+
+    def iter_items(self) -> Iterator[tuple[str, Any]]:
+        """Iterate over all key-value pairs in the storage page by page
+
+        Yields:
+            tuple[str, Any]: Key-value pairs in key order
+
+        Note:
+            Only one page is held in memory at a time and the lock is released between pages, so changes made during the iteration may or may not be seen
+        """
+
+        page = self._items_page(None)
+        while page:
+            yield from page
+            page = self._items_page(page[-1][0])
+
+    @synchronized
+    def items(self) -> list[tuple[str, Any]]:
+        """Get all key-value pairs in the storage
+
+        Returns:
+            list[tuple[str, Any]]: List of all key-value pairs
+        """
+
+        return [
+            (key, decode_json(value))
+            for key, value in self.connection.execute("SELECT key, value FROM items")
+        ]
+
+    @synchronized
+    def exists(self, key: str) -> bool:
+        """Check if a key exists in the storage
+
+        Args:
+            key (str): The key to check
+
+        Returns:
+            bool: True if key exists, False otherwise
+        """
+
+        row = self.connection.execute(
+            "SELECT 1 FROM items WHERE key = ?", (key,)
+        ).fetchone()
+        return row is not None
+
+    @synchronized
+    def clear(self) -> None:
+        """Remove all key-value pairs from the storage
+
+        Note:
+            The removal is persisted on flush()
+        """
+        self.connection.execute("DELETE FROM items")
+
+    @synchronized
+    def rebalance(self, new_buckets_count: int) -> int:
+        """Accept a new number of buckets for compatibility with KVStorage
+
+        Args:
+            new_buckets_count (int): The new number of buckets
+
+        Returns:
+            int: Number of items in the storage
+
+        Raises:
+            ValueError: If new_buckets_count <= 0
+
+        Note:
+            All pairs live in one indexed table, so there is nothing to redistribute
+        """
+        if new_buckets_count <= 0:
+            raise ValueError("Invalid buckets count")
+
+        return self.connection.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+
+    @synchronized
+    def flush(self) -> None:
+        """Commit all pending modifications to disk"""
+        self.connection.commit()
+
+    @synchronized
+    def sync(self) -> None:
+        """Commit pending modifications and copy the write-ahead log into the database file
+
+        Note:
+            Commits are already synced to the write-ahead log, the checkpoint keeps the log from growing between syncs
+        """
+        self.connection.commit()
+        self.connection.execute("PRAGMA wal_checkpoint(FULL)")
+
+    def __enter__(self) -> "SQLiteKVStorage":
+        """Return the storage itself, so it can be used in a with block"""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        """Commit pending modifications and close the database when leaving a with block"""
+        self.close()
+
+    @synchronized
+    def close(self) -> None:
+        """Commit pending modifications and close the database"""
+        self.connection.commit()
+        self.connection.close()
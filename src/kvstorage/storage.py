@@ -1,9 +1,180 @@
-import hashlib
 import json
+import mmap
 import os
+import re
+import threading
+import zlib
 
-from collections import OrderedDict
-from typing import Any
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Iterable, Iterator, Optional
+
+from .bloom import BloomFilter
+from .common import decode_json, encode_json, encode_value, synchronized, validate_key
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Bucket files of at least this size are parsed straight from a memory map
+MMAP_MIN_SIZE = 1 << 20
+
+# A bucket log is compacted once it holds more appended records than this or than live keys
+COMPACT_MIN_RECORDS = 64
+
+# Version of the key to bucket assignment, storages without a layout file were written with SHA-256 placement (version 0)
+LAYOUT_VERSION = 1
+LAYOUT_FILE = "layout.json"
+
+BUCKET_FILE_PATTERN = re.compile(r"bucket_(\d+)\.kvs")
+
+
+def _write_file_atomic(path: str, data: bytes, durable: bool = True) -> None:
+    """Replace the contents of a file atomically
+
+    Args:
+        path (str): The path of the file
+        data (bytes): The new contents
+        durable (bool): Whether the temporary file is forced to stable storage before the rename (default: True)
+
+    Note:
+        Writes a temporary file first so a crash never leaves a truncated file behind. A durable file reaches stable storage before the rename, otherwise the rename could be persisted ahead of the data. Files that can be rebuilt, such as key indexes, skip the sync
+    """
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        if durable:
+            f.flush()
+            _datasync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _datasync(fd: int) -> None:
+    """Force the contents of an open file to stable storage
+
+    Args:
+        fd (int): The file descriptor
+
+    Note:
+        fdatasync skips metadata that is not needed to read the data back, such as timestamps. Platforms without it fall back to fsync
+    """
+
+    if hasattr(os, "fdatasync"):
+        os.fdatasync(fd)
+    else:
+        os.fsync(fd)
+
+
+def _apply_records(bucket: dict[str, Any], data, source, end: int) -> Optional[int]:
+    """Apply the log records that follow a bucket snapshot
+
+    Args:
+        bucket (dict[str, any]): The bucket to update in place
+        data (bytes | mmap.mmap): The contents of the bucket file
+        source (bytes | memoryview): The same contents, sliced to decode the records
+        end (int): The offset of the newline in front of the first record
+
+    Returns:
+        Optional[int]: The number of applied records, None if the last record was cut short by a crash and ignored
+
+    Raises:
+        json.JSONDecodeError: If a record other than the last one is not valid
+    """
+
+    records = 0
+    while end < len(data):
+        start = end + 1
+        end = data.find(b"\n", start)
+        if end == -1:
+            end = len(data)
+
+        try:
+            record = decode_json(source[start:end])
+        except json.JSONDecodeError:
+            if end == len(data):
+                return None
+            raise
+
+        if len(record) == 2:
+            bucket[record[0]] = record[1]
+        else:
+            bucket.pop(record[0], None)
+        records += 1
+
+    return records
+
+
+def _parse_bucket(data) -> tuple[dict[str, Any], Optional[int]]:
+    """Rebuild a bucket from its snapshot and the records appended after it
+
+    Args:
+        data (bytes | mmap.mmap): The contents of the bucket file
+
+    Returns:
+        tuple[dict[str, any], Optional[int]]: The contents of the bucket and the number of appended records (None for a file in the legacy single-document format or with a torn last record)
+
+    Raises:
+        json.JSONDecodeError: If the file is not valid
+
+    Note:
+        The first line is a JSON object with the bucket snapshot, every following line is a [key, value] record for a set key or a [key] record for a deleted key. A trailing record cut short by a crash is ignored, the None count makes the next write replace the file with a snapshot instead of appending after the torn record
+    """
+
+    # orjson parses memoryview slices without copying them out of the buffer
+    source = memoryview(data) if orjson is not None else data
+    try:
+        end = data.find(b"\n")
+        if end == -1:
+            end = len(data)
+
+        try:
+            bucket = decode_json(source[:end])
+        except json.JSONDecodeError:
+            # Buckets written before the log format are a single pretty-printed document
+            return decode_json(source), None
+
+        return bucket, _apply_records(bucket, data, source, end)
+    finally:
+        if isinstance(source, memoryview):
+            source.release()
+
+
+def _read_bucket_file(f) -> tuple[dict[str, Any], Optional[int]]:
+    """Read and deserialize an open bucket file
+
+    Args:
+        f (BinaryIO): The bucket file opened in binary mode
+
+    Returns:
+        tuple[dict[str, any], Optional[int]]: The contents of the bucket and the number of appended records (see _parse_bucket)
+
+    Raises:
+        json.JSONDecodeError: If the file is not valid
+
+    Note:
+        Large files are memory-mapped when orjson is available, so the file is parsed from the page cache without first being copied into a bytes object
+    """
+
+    if orjson is not None and os.fstat(f.fileno()).st_size >= MMAP_MIN_SIZE:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return _parse_bucket(mm)
+
+    return _parse_bucket(f.read())
+
+
+def _round_to_power_of_two(n: int) -> int:
+    """Round a positive number up to the nearest power of two
+
+    Args:
+        n (int): The number to round
+
+    Returns:
+        int: The smallest power of two that is >= n
+    """
+
+    return 1 << (n - 1).bit_length()
 
 
 class KeyNotFoundError(Exception):
@@ -12,24 +183,39 @@ class KeyNotFoundError(Exception):
     pass
 
 
+class CorruptedBucketError(Exception):
+    """Raised when a bucket file cannot be decoded"""
+
+    pass
+
+
 class KVStorage:
     """Key-value storage class
 
-    Stores key-value pairs in a directory using multiple bucket files. Each bucket is a separate JSON file. Keys are hashed to determine their bucket
+    Stores key-value pairs in a directory using multiple bucket files. Each bucket is a separate file holding a JSON snapshot followed by an append-only log of changes. Keys are hashed to determine their bucket
+
+    Modifications are kept in the bucket cache and appended to the bucket file when a modified bucket is evicted or flush() is called. A bucket file is compacted back into a single snapshot once its log outgrows the live data
+
+    Public methods are thread-safe, they are serialized by a storage-wide lock
     """
 
     def __init__(
-        self, storage_name="kvstorage", buckets_count=16, max_cached_buckets=2
+        self,
+        storage_name="kvstorage",
+        buckets_count=16,
+        max_cached_buckets=2,
+        value_cache_size=1024,
     ):
         """Initialize the key-value storage
 
         Args:
             storage_name (str): The name of the storage directory (default: "kvstorage")
-            buckets_count (int): The number of buckets to use for storage (default: 16)
+            buckets_count (int): The number of buckets to use for storage, rounded up to a power of two (default: 16)
             max_cached_buckets (int): The maximum number of cached buckets (default: 2)
+            value_cache_size (int): The maximum number of values kept in the hot-key cache, 0 disables it (default: 1024)
 
         Raises:
-            ValueError: If storage_name is empty/whitespace, buckets_count <= 0, or max_cached_buckets <= 0
+            ValueError: If storage_name is empty/whitespace, buckets_count <= 0, max_cached_buckets <= 0, or value_cache_size < 0
             FileExistsError: If storage_name exists and is not a directory
         """
 
@@ -42,15 +228,88 @@ class KVStorage:
         if max_cached_buckets <= 0:
             raise ValueError("Invalid max cached buckets count")
 
+        if value_cache_size < 0:
+            raise ValueError("Invalid value cache size")
+
+        self._lock = threading.RLock()
         self.storage_name = storage_name
-        self.buckets_count = buckets_count
+        self.buckets_count = _round_to_power_of_two(buckets_count)
+        self.bucket_mask = self.buckets_count - 1
         self.max_cached_buckets = max_cached_buckets
+        self.value_cache_size = value_cache_size
 
         if os.path.exists(self.storage_name) and not os.path.isdir(self.storage_name):
             raise FileExistsError(f"{self.storage_name} exists and is not a directory")
         os.makedirs(self.storage_name, exist_ok=True)
 
-        self.bucket_cache = OrderedDict()
+        # Plain dicts keep insertion order, so the first key is the least recently used bucket
+        self.bucket_cache: dict[int, dict[str, Any]] = {}
+        self.dirty_buckets: set[int] = set()
+        self.changed_keys: dict[int, set[str]] = {}
+        # Records appended to each cached bucket file since its snapshot, None if it has to be rewritten
+        self.appended_records: dict[int, Optional[int]] = {}
+        # Buckets written since the last sync(), they may still sit in the OS page cache
+        self.unsynced_buckets: set[int] = set()
+        self.value_cache: OrderedDict[str, Any] = OrderedDict()
+        self.bloom_filters: dict[int, BloomFilter] = {}
+        # Maps every key to its bucket, built on the first keys() call and kept in sync afterwards
+        self.key_index: Optional[dict[str, int]] = None
+        self._build_paths()
+        self._migrate_layout()
+
+    def _build_paths(self) -> None:
+        """Precompute the bucket and key index file paths of all buckets"""
+        self._bucket_paths = [
+            os.path.join(self.storage_name, f"bucket_{bucket_id}.kvs")
+            for bucket_id in range(self.buckets_count)
+        ]
+        self._keys_paths = [
+            os.path.join(self.storage_name, f"bucket_{bucket_id}.keys")
+            for bucket_id in range(self.buckets_count)
+        ]
+
+    def _migrate_layout(self) -> None:
+        """Move the keys of a storage written with an older bucket layout to their current buckets
+
+        Raises:
+            CorruptedBucketError: If a bucket file of the old layout has invalid JSON
+
+        Note:
+            The bucket count of the old layout is taken from the bucket files found in the storage directory. The layout file is written once the keys are moved, so an interrupted migration is repeated on the next open. A storage without bucket files gets its layout file with the first bucket written
+        """
+
+        try:
+            with open(os.path.join(self.storage_name, LAYOUT_FILE), "rb") as f:
+                version = decode_json(f.read()).get("version", 0)
+        except FileNotFoundError:
+            version = 0
+
+        # Also keeps the buckets saved during the migration from writing the layout file early
+        self.layout_saved = version >= LAYOUT_VERSION
+        if self.layout_saved:
+            return
+
+        bucket_ids = []
+        for name in os.listdir(self.storage_name):
+            match = BUCKET_FILE_PATTERN.fullmatch(name)
+            if match:
+                bucket_ids.append(int(match.group(1)))
+
+        if bucket_ids:
+            buckets_count = self.buckets_count
+            self.buckets_count = max(bucket_ids) + 1
+            self._build_paths()
+            self.layout_saved = True
+            self.rebalance(buckets_count)
+            self._save_layout()
+
+    def _save_layout(self) -> None:
+        """Write the layout file that marks the storage as using the current bucket layout"""
+        _write_file_atomic(
+            os.path.join(self.storage_name, LAYOUT_FILE),
+            encode_json({"version": LAYOUT_VERSION}),
+        )
+        self.layout_saved = True
 
     def _bucket_path(self, bucket_id: int) -> str:
         """Get the file path for a specific bucket
@@ -62,8 +321,24 @@ class KVStorage:
             str: The file path for the bucket
         """
 
+        if bucket_id < self.buckets_count:
+            return self._bucket_paths[bucket_id]
         return os.path.join(self.storage_name, f"bucket_{bucket_id}.kvs")
 
+    def _keys_path(self, bucket_id: int) -> str:
+        """Get the file path for the key index of a specific bucket
+
+        Args:
+            bucket_id (int): The ID of the bucket
+
+        Returns:
+            str: The file path for the key index
+        """
+
+        if bucket_id < self.buckets_count:
+            return self._keys_paths[bucket_id]
+        return os.path.join(self.storage_name, f"bucket_{bucket_id}.keys")
+
     def _get_bucket_id(self, key: str) -> int:
         """Get the bucket ID for a specific key
 
@@ -72,10 +347,12 @@ class KVStorage:
 
         Returns:
             int: The ID of the bucket
+
+        Note:
+            CRC-32 is used because bucket assignment only needs a fast, stable and evenly distributed hash, not a cryptographic one. The bucket count is a power of two, so the bucket is selected with a bit mask instead of a modulo
         """
 
-        hash = hashlib.sha256(key.encode("utf-8")).hexdigest()
-        return int(hash, 16) % self.buckets_count
+        return zlib.crc32(key.encode("utf-8")) & self.bucket_mask
 
     def _load_bucket(self, bucket_id: int) -> dict[str, Any]:
         """Load a bucket from file or cache
@@ -86,49 +363,308 @@ class KVStorage:
         Returns:
             dict[str, any]: The contents of the bucket
 
-        Note:
-            If the bucket file has invalid JSON, returns an empty dictionary
+        Raises:
+            CorruptedBucketError: If the bucket file has invalid JSON
         """
 
         if bucket_id in self.bucket_cache:
-            # Mark as recently used
-            self.bucket_cache.move_to_end(bucket_id)
+            # Mark as recently used by moving it to the end, unless it is already there
+            if next(reversed(self.bucket_cache)) == bucket_id:
+                return self.bucket_cache[bucket_id]
 
-            return self.bucket_cache[bucket_id]
+            cache = self.bucket_cache.pop(bucket_id)
+            self.bucket_cache[bucket_id] = cache
 
-        if len(self.bucket_cache) >= self.max_cached_buckets:
-            self._save_bucket(*self.bucket_cache.popitem(last=False))
+            return cache
 
-        cache = {}
-        path = self._bucket_path(bucket_id)
+        if len(self.bucket_cache) >= self.max_cached_buckets:
+            evicted_id = next(iter(self.bucket_cache))
 
-        if os.path.exists(path):
-            with open(path, "r", encoding="utf-8") as f:
-                try:
-                    cache = json.load(f)
-                except json.JSONDecodeError as e:
-                    print(f"Error loading bucket {bucket_id}: {e}")
-                    cache = {}
+            # Only buckets modified since the last save have to be written back, a failed write keeps the bucket cached
+            if evicted_id in self.dirty_buckets:
+                self._write_bucket(evicted_id, self.bucket_cache[evicted_id])
+                self.dirty_buckets.discard(evicted_id)
+            del self.bucket_cache[evicted_id]
+            self.appended_records.pop(evicted_id, None)
 
+        cache, self.appended_records[bucket_id] = self._read_bucket_log(bucket_id)
         self.bucket_cache[bucket_id] = cache
         return cache
 
+    def _read_bucket_log(self, bucket_id: int) -> tuple[dict[str, Any], Optional[int]]:
+        """Read a bucket and the length of its change log from file without caching it
+
+        Args:
+            bucket_id (int): The ID of the bucket to read
+
+        Returns:
+            tuple[dict[str, any], Optional[int]]: The contents of the bucket (empty if the file does not exist) and the number of records appended since its snapshot (None if the file does not exist or is in the legacy format)
+
+        Raises:
+            CorruptedBucketError: If the bucket file has invalid JSON
+        """
+
+        path = self._bucket_path(bucket_id)
+        if not os.path.exists(path):
+            return {}, None
+
+        with open(path, "rb") as f:
+            try:
+                return _read_bucket_file(f)
+            except json.JSONDecodeError as e:
+                raise CorruptedBucketError(
+                    f"Error loading bucket {bucket_id}: {e}"
+                ) from e
+
+    def _read_bucket(self, bucket_id: int) -> dict[str, Any]:
+        """Read a bucket from file without caching it
+
+        Args:
+            bucket_id (int): The ID of the bucket to read
+
+        Returns:
+            dict[str, any]: The contents of the bucket (empty if the file does not exist)
+
+        Raises:
+            CorruptedBucketError: If the bucket file has invalid JSON
+        """
+
+        return self._read_bucket_log(bucket_id)[0]
+
+    def _read_index(self, bucket_id: int) -> Optional[tuple[list[str], BloomFilter]]:
+        """Read the key index of a bucket
+
+        Args:
+            bucket_id (int): The ID of the bucket
+
+        Returns:
+            Optional[tuple[list[str], BloomFilter]]: The keys of the bucket and their bloom filter (empty if the bucket file does not exist), or None if the index is missing or stale
+
+        Note:
+            The index describes the snapshot of the bucket file, records appended after the snapshot are read from the end of the bucket file and applied to it
+        """
+
+        bucket_path = self._bucket_path(bucket_id)
+        try:
+            stat = os.stat(bucket_path)
+        except FileNotFoundError:
+            return [], BloomFilter()
+
+        try:
+            with open(self._keys_path(bucket_id), "rb") as f:
+                index = decode_json(f.read())
+        except (OSError, json.JSONDecodeError):
+            return None
+
+        # Snapshots are written to a new file, appends keep the file and only make it longer
+        snapshot = index.get("snapshot")
+        if snapshot is None or snapshot[0] != stat.st_ino or stat.st_size < snapshot[1]:
+            return None
+
+        keys = index["keys"]
+        bloom = BloomFilter.from_dict(index["bloom"])
+        if stat.st_size == snapshot[1]:
+            return keys, bloom
+
+        with open(bucket_path, "rb") as f:
+            f.seek(snapshot[1] - 1)
+            log = f.read()
+
+        # The snapshot ends with "}" and every record starts with a newline, anything else was rewritten in place
+        if not log.startswith(b"}\n"):
+            return None
+
+        bucket = dict.fromkeys(keys)
+        try:
+            _apply_records(bucket, log, log, 1)
+        except json.JSONDecodeError:
+            return None
+
+        for key in bucket.keys() - set(keys):
+            bloom.add(key)
+        return list(bucket), bloom
+
+    def _might_contain(self, bucket_id: int, key: str) -> bool:
+        """Check whether an uncached bucket may contain a key without loading it
+
+        Args:
+            bucket_id (int): The ID of the bucket
+            key (str): The key to check
+
+        Returns:
+            bool: False if the key is definitely not in the bucket, True otherwise
+        """
+
+        bloom = self.bloom_filters.get(bucket_id)
+        if bloom is None:
+            index = self._read_index(bucket_id)
+            if index is None:
+                return True
+
+            bloom = index[1]
+            self.bloom_filters[bucket_id] = bloom
+
+        return bloom.might_contain(key)
+
     def _save_bucket(
         self, bucket_id: int, bucket_content: dict[str, Any] = None
     ) -> None:
-        """Save a bucket to file system
+        """Save a bucket to file system as a fresh snapshot
 
         Args:
             bucket_id (int): The ID of the bucket to save
             bucket_content (dict[str, any], optional): The contents of the bucket to save (if None, the cached content will be used, defaults to None)
         """
 
+        if not self.layout_saved:
+            self._save_layout()
+
+        # A crash before the new index is saved must not leave the old one behind, the new file could reuse its inode number
+        try:
+            os.remove(self._keys_path(bucket_id))
+        except FileNotFoundError:
+            pass
+
         cache = bucket_content or self.bucket_cache.get(bucket_id, {})
-        path = self._bucket_path(bucket_id)
+        _write_file_atomic(self._bucket_path(bucket_id), encode_json(cache))
+        self.appended_records[bucket_id] = 0
+        self.unsynced_buckets.add(bucket_id)
+        # A snapshot resizes the bloom filter for the current keys and drops deleted ones
+        self._save_index(bucket_id, cache, BloomFilter.from_keys(cache))
+
+    def _append_records(
+        self, bucket_id: int, bucket: dict[str, Any], keys: Iterable[str]
+    ) -> None:
+        """Append the current state of some keys to the log of a bucket
+
+        Args:
+            bucket_id (int): The ID of the bucket
+            bucket (dict[str, any]): The contents of the bucket
+            keys (Iterable[str]): The keys that changed since the bucket was last written
+
+        Note:
+            The key index file is left as it is, readers apply the appended records to it
+        """
+
+        records = [
+            encode_json([key, bucket[key]] if key in bucket else [key]) for key in keys
+        ]
+        # Records are newline-prefixed, so a torn append never merges with the next one
+        with open(self._bucket_path(bucket_id), "ab") as f:
+            f.write(b"\n" + b"\n".join(records))
+
+        self.appended_records[bucket_id] += len(records)
+        self.unsynced_buckets.add(bucket_id)
+
+        # Deleted keys stay in the filter until the next snapshot, they only cost false positives
+        bloom = self.bloom_filters.get(bucket_id)
+        if bloom is not None:
+            for key in keys:
+                if key in bucket:
+                    bloom.add(key)
+
+    def _write_bucket(self, bucket_id: int, bucket: dict[str, Any]) -> None:
+        """Write the unsaved changes of a bucket to file system
+
+        Args:
+            bucket_id (int): The ID of the bucket
+            bucket (dict[str, any]): The contents of the bucket
+
+        Note:
+            Changed keys are appended to the bucket log. The bucket is rewritten as a snapshot instead when it has no file yet, is in the legacy format, or its log would outgrow the live data. The changed keys are kept if the write fails
+        """
+
+        changed = self.changed_keys.get(bucket_id, ())
+        appended = self.appended_records.get(bucket_id)
+        if appended is None or appended + len(changed) > max(
+            len(bucket), COMPACT_MIN_RECORDS
+        ):
+            self._save_bucket(bucket_id, bucket)
+        else:
+            try:
+                self._append_records(bucket_id, bucket, changed)
+            except Exception:
+                # Part of the records may have reached the file, the next write replaces it with a snapshot
+                self.appended_records[bucket_id] = None
+                raise
+        self.changed_keys.pop(bucket_id, None)
+
+    def _save_index(
+        self, bucket_id: int, bucket: dict[str, Any], bloom: BloomFilter
+    ) -> None:
+        """Save the key index and bloom filter of a bucket
+
+        Args:
+            bucket_id (int): The ID of the bucket
+            bucket (dict[str, any]): The contents of the bucket
+            bloom (BloomFilter): The bloom filter holding every key of the bucket
+        """
+
+        self.bloom_filters[bucket_id] = bloom
+
+        # The key index records which snapshot it describes, so a stale index is never trusted
+        stat = os.stat(self._bucket_path(bucket_id))
+        index = {
+            "snapshot": [stat.st_ino, stat.st_size],
+            "keys": list(bucket),
+            "bloom": bloom.to_dict(),
+        }
+        # The index is validated against the bucket file on read and rebuilt when stale, so it is not synced
+        _write_file_atomic(
+            self._keys_path(bucket_id), encode_json(index), durable=False
+        )
+
+    def _mark_dirty(self, bucket_id: int, key: str) -> None:
+        """Record that a key of a cached bucket was changed
+
+        Args:
+            bucket_id (int): The ID of the bucket
+            key (str): The changed key
+        """
+
+        self.dirty_buckets.add(bucket_id)
+        self.changed_keys.setdefault(bucket_id, set()).add(key)
+
+    def _validate_value(self, value: Any) -> None:
+        """Validate a value before it is written
+
+        Args:
+            value (any): The value to validate
+
+        Raises:
+            ValueError: If the value cannot be encoded as JSON
+
+        Note:
+            Values are only encoded when their bucket is written, a value that cannot be encoded would otherwise keep its bucket from ever being written
+        """
+
+        encode_value(value)
+
+    def _group_by_bucket(self, keys: Iterable[str]) -> dict[int, list[str]]:
+        """Group keys by the bucket they belong to
+
+        Args:
+            keys (Iterable[str]): The keys to group
+
+        Returns:
+            dict[int, list[str]]: Keys grouped by bucket ID, cached buckets first
+
+        Note:
+            Visiting cached buckets first keeps them from being evicted and loaded again later in the same batch
+        """
 
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(cache, f, ensure_ascii=False, indent=2)
+        groups = defaultdict(list)
+        for key in keys:
+            groups[self._get_bucket_id(key)].append(key)
 
+        return dict(
+            sorted(
+                groups.items(),
+                key=lambda group: (group[0] not in self.bucket_cache, group[0]),
+            )
+        )
+
+    @synchronized
     def set(self, key: str, value: Any) -> None:
         """Set a key-value pair in the storage
 
@@ -137,20 +673,24 @@ class KVStorage:
             value (any): The value to set
 
         Raises:
-            ValueError: If the key is empty, whitespace, or not a string
-        """
+            ValueError: If the key is empty, whitespace, or not a string, or the value cannot be encoded as JSON
 
-        if not key or not key.strip():
-            raise ValueError("Invalid key")
+        Note:
+            The change is persisted on flush() or when the bucket is evicted from the cache
+        """
 
-        if not isinstance(key, str):
-            raise ValueError("Key must be a string")
+        validate_key(key)
+        self._validate_value(value)
 
         bucket_id = self._get_bucket_id(key)
         bucket = self._load_bucket(bucket_id)
         bucket[key] = value
-        self._save_bucket(bucket_id)
+        self._mark_dirty(bucket_id, key)
+        self.value_cache.pop(key, None)
+        if self.key_index is not None:
+            self.key_index[key] = bucket_id
 
+    @synchronized
     def get(self, key: str) -> Any:
         """Get a value from the storage
 
@@ -164,13 +704,28 @@ class KVStorage:
             No key validation
         """
 
+        if key in self.value_cache:
+            # Mark as recently used
+            self.value_cache.move_to_end(key)
+
+            return self.value_cache[key]
+
         id = self._get_bucket_id(key)
-        bucket = self._load_bucket(id)
+        if id not in self.bucket_cache and not self._might_contain(id, key):
+            raise KeyNotFoundError("Key not found")
 
+        bucket = self._load_bucket(id)
         if key not in bucket:
             raise KeyNotFoundError("Key not found")
-        return bucket[key]
 
+        value = bucket[key]
+        if self.value_cache_size:
+            self.value_cache[key] = value
+            if len(self.value_cache) > self.value_cache_size:
+                self.value_cache.popitem(last=False)
+        return value
+
+    @synchronized
     def delete(self, key: str) -> Any:
         """Delete a key-value pair from the storage
 
@@ -181,36 +736,237 @@ class KVStorage:
             any: Value associated with the key (None if not found)
         """
 
+        return self.pop(key)[1]
+
+    @synchronized
+    def pop(self, key: str) -> tuple[bool, Any]:
+        """Delete a key-value pair and report whether it existed
+
+        Args:
+            key (str): The key to delete
+
+        Returns:
+            tuple[bool, any]: Whether the key existed and its value (None if not found)
+        """
+
         id = self._get_bucket_id(key)
         bucket = self._load_bucket(id)
-        value = bucket.pop(key, None)
-        self._save_bucket(id)
-        return value
+        if key not in bucket:
+            return False, None
+
+        value = bucket.pop(key)
+        self._mark_dirty(id, key)
+        self.value_cache.pop(key, None)
+        if self.key_index is not None:
+            self.key_index.pop(key, None)
+        return True, value
+
+    @synchronized
+    def set_if_absent(self, key: str, value: Any) -> bool:
+        """Set a key-value pair only if the key does not exist yet
+
+        Args:
+            key (str): The key to set
+            value (any): The value to set
+
+        Returns:
+            bool: True if the pair was set, False if the key already exists
+
+        Raises:
+            ValueError: If the key is empty, whitespace, or not a string, or the value cannot be encoded as JSON
+        """
+
+        validate_key(key)
+        self._validate_value(value)
+
+        bucket_id = self._get_bucket_id(key)
+        bucket = self._load_bucket(bucket_id)
+        if key in bucket:
+            return False
+
+        bucket[key] = value
+        self._mark_dirty(bucket_id, key)
+        self.value_cache.pop(key, None)
+        if self.key_index is not None:
+            self.key_index[key] = bucket_id
+        return True
+
+    @synchronized
+    def set_if_exists(self, key: str, value: Any) -> bool:
+        """Replace the value of a key only if the key already exists
+
+        Args:
+            key (str): The key to set
+            value (any): The value to set
+
+        Returns:
+            bool: True if the value was replaced, False if the key does not exist
+
+        Raises:
+            ValueError: If the value cannot be encoded as JSON
+        """
+
+        self._validate_value(value)
+        bucket_id = self._get_bucket_id(key)
+        bucket = self._load_bucket(bucket_id)
+        if key not in bucket:
+            return False
+
+        bucket[key] = value
+        self._mark_dirty(bucket_id, key)
+        self.value_cache.pop(key, None)
+        return True
+
+    @synchronized
+    def set_many(self, pairs: Iterable[tuple[str, Any]]) -> None:
+        """Set multiple key-value pairs, loading each affected bucket only once
+
+        Args:
+            pairs (Iterable[tuple[str, any]]): The key-value pairs to set
+
+        Raises:
+            ValueError: If any key is empty, whitespace, or not a string, or any value cannot be encoded as JSON (nothing is set in that case)
+        """
+
+        pairs = dict(pairs)
+        for key, value in pairs.items():
+            validate_key(key)
+            self._validate_value(value)
+
+        for bucket_id, keys in self._group_by_bucket(pairs).items():
+            bucket = self._load_bucket(bucket_id)
+            for key in keys:
+                bucket[key] = pairs[key]
+                self._mark_dirty(bucket_id, key)
+                self.value_cache.pop(key, None)
+                if self.key_index is not None:
+                    self.key_index[key] = bucket_id
+
+    @synchronized
+    def get_many(self, keys: Iterable[str]) -> dict[str, Any]:
+        """Get multiple values, loading each affected bucket only once
+
+        Args:
+            keys (Iterable[str]): The keys to get
+
+        Returns:
+            dict[str, any]: Values of the keys that exist in the storage
+        """
+
+        values = {}
+        for bucket_id, bucket_keys in self._group_by_bucket(keys).items():
+            bucket = self._load_bucket(bucket_id)
+            for key in bucket_keys:
+                if key in bucket:
+                    values[key] = bucket[key]
+        return values
+
+    @synchronized
+    def delete_many(self, keys: Iterable[str]) -> dict[str, Any]:
+        """Delete multiple keys, loading each affected bucket only once
+
+        Args:
+            keys (Iterable[str]): The keys to delete
+
+        Returns:
+            dict[str, any]: Values of the keys that were deleted
+        """
 
+        deleted = {}
+        for bucket_id, bucket_keys in self._group_by_bucket(keys).items():
+            bucket = self._load_bucket(bucket_id)
+            for key in bucket_keys:
+                if key in bucket:
+                    deleted[key] = bucket.pop(key)
+                    self.value_cache.pop(key, None)
+                    self._mark_dirty(bucket_id, key)
+                    if self.key_index is not None:
+                        self.key_index.pop(key, None)
+        return deleted
+
+    def _bucket_keys(self, bucket_id: int) -> list[str]:
+        """Get the keys of a bucket without loading it into the cache
+
+        Args:
+            bucket_id (int): The ID of the bucket
+
+        Returns:
+            list[str]: The keys stored in the bucket
+
+        Note:
+            Buckets that are not cached are listed from their key index files, so values are not parsed
+        """
+
+        if bucket_id in self.bucket_cache:
+            return list(self.bucket_cache[bucket_id])
+
+        index = self._read_index(bucket_id)
+        if index is None:
+            return list(self._read_bucket(bucket_id))
+        return index[0]
+
+    @synchronized
     def keys(self) -> list[str]:
         """Get all keys in the storage
 
         Returns:
             list[str]: List of all keys in the storage
+
+        Note:
+            The first call scans the key index files of all buckets, later calls are answered from memory. The bucket cache is left untouched
+        """
+
+        if self.key_index is None:
+            self.key_index = {
+                key: bucket_id
+                for bucket_id in range(self.buckets_count)
+                for key in self._bucket_keys(bucket_id)
+            }
+        return list(self.key_index)
+
+    @synchronized
+    def _bucket_items(self, bucket_id: int) -> list[tuple[str, Any]]:
+        """Get the key-value pairs of a bucket without loading it into the cache
+
+        Args:
+            bucket_id (int): The ID of the bucket
+
+        Returns:
+            list[tuple[str, Any]]: The key-value pairs stored in the bucket
+        """
+
+        if bucket_id in self.bucket_cache:
+            return list(self.bucket_cache[bucket_id].items())
+        return list(self._read_bucket(bucket_id).items())
+
+    def iter_items(self) -> Iterator[tuple[str, Any]]:
+        """Iterate over all key-value pairs in the storage bucket by bucket
+
+        Yields:
+            tuple[str, Any]: Key-value pairs
+
+        Note:
+            Only one bucket is held in memory at a time and the lock is released between buckets, so changes made during the iteration may or may not be seen
         """
-        all_keys = []
-        for bucket_id in range(self.buckets_count):
-            bucket = self._load_bucket(bucket_id)
-            all_keys.extend(bucket.keys())
-        return all_keys
 
+        bucket_id = 0
+        while bucket_id < self.buckets_count:
+            yield from self._bucket_items(bucket_id)
+            bucket_id += 1
+
+    @synchronized
     def items(self) -> list[tuple[str, Any]]:
         """Get all key-value pairs in the storage
 
         Returns:
             list[tuple[str, Any]]: List of all key-value pairs
+
+        Note:
+            Buckets that are not cached are read straight from disk, so listing does not evict hot buckets from the cache
         """
-        all_items = []
-        for bucket_id in range(self.buckets_count):
-            bucket = self._load_bucket(bucket_id)
-            all_items.extend(bucket.items())
-        return all_items
+        return list(self.iter_items())
 
+    @synchronized
     def exists(self, key: str) -> bool:
         """Check if a key exists in the storage
 
@@ -219,44 +975,188 @@ class KVStorage:
 
         Returns:
             bool: True if key exists, False otherwise
+
+        Note:
+            Answered from the key index once keys() has built it, otherwise uncached buckets are ruled out by their bloom filter before being loaded
         """
+        if self.key_index is not None:
+            return key in self.key_index
+
         bucket_id = self._get_bucket_id(key)
+        if bucket_id not in self.bucket_cache and not self._might_contain(
+            bucket_id, key
+        ):
+            return False
+
         bucket = self._load_bucket(bucket_id)
         return key in bucket
 
+    @synchronized
     def flush(self) -> None:
-        """Flush all cached buckets to disk"""
-        for bucket_id, bucket_content in list(self.bucket_cache.items()):
-            self._save_bucket(bucket_id, bucket_content)
-        self.bucket_cache.clear()
+        """Write all modified buckets to disk
 
+        Raises:
+            OSError: If a bucket could not be written, the first error is raised after every other bucket was written
+
+        Note:
+            Buckets stay cached after flushing, only their dirty flag is cleared. A bucket that could not be written stays dirty
+        """
+        error = None
+        for bucket_id in sorted(self.dirty_buckets):
+            try:
+                self._write_bucket(bucket_id, self.bucket_cache[bucket_id])
+            except Exception as e:
+                if error is None:
+                    error = e
+            else:
+                self.dirty_buckets.discard(bucket_id)
+
+        if error is not None:
+            raise error
+
+    @synchronized
+    def sync(self) -> None:
+        """Force the bucket files written since the last sync to stable storage
+
+        Note:
+            flush() only hands the data to the operating system. Calling sync() periodically instead of after every write lets many writes share one sync, a crash can lose the writes made since the last sync
+        """
+        for bucket_id in sorted(self.unsynced_buckets):
+            path = self._bucket_path(bucket_id)
+            if not os.path.exists(path):
+                continue
+
+            with open(path, "rb") as f:
+                _datasync(f.fileno())
+
+        # Renames and new files are only durable once their directory entry is synced
+        if self.unsynced_buckets and os.name == "posix":
+            fd = os.open(self.storage_name, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        self.unsynced_buckets.clear()
+
+    def __enter__(self) -> "KVStorage":
+        """Return the storage itself, so it can be used in a with block"""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        """Write all modified buckets to stable storage when leaving a with block"""
+        self.flush()
+        self.sync()
+
+    def _remove_bucket_files(self, bucket_id: int) -> None:
+        """Remove the bucket file and key index of a specific bucket
+
+        Args:
+            bucket_id (int): The ID of the bucket
+        """
+
+        for path in (self._bucket_path(bucket_id), self._keys_path(bucket_id)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    @synchronized
+    def clear(self) -> None:
+        """Remove all key-value pairs from the storage
+
+        Note:
+            Deletes the bucket files and key indexes and resets every cache, unsaved changes are discarded
+        """
+        for bucket_id in range(self.buckets_count):
+            self._remove_bucket_files(bucket_id)
+
+        self.bucket_cache.clear()
+        self.dirty_buckets.clear()
+        self.changed_keys.clear()
+        self.appended_records.clear()
+        self.unsynced_buckets.clear()
+        self.value_cache.clear()
+        self.bloom_filters.clear()
+        self.key_index = {}
+
+    @synchronized
     def rebalance(self, new_buckets_count: int) -> int:
         """Rebalance storage with a new number of buckets
 
         Args:
-            new_buckets_count (int): The new number of buckets
+            new_buckets_count (int): The new number of buckets, rounded up to a power of two
 
         Returns:
-            int: Number of items rebalanced
+            int: Number of items in the rebalanced storage
 
         Raises:
             ValueError: If new_buckets_count <= 0
+
+        Note:
+            Only keys whose bucket changes are moved and only buckets whose contents change are rewritten. Growing from N to 2N buckets moves about half of the keys, while a key placed by an older hash is moved to its current bucket
         """
         if new_buckets_count <= 0:
             raise ValueError("Invalid buckets count")
 
-        all_items = self.items()
         self.flush()
-
-        for bucket_id in range(self.buckets_count):
-            path = self._bucket_path(bucket_id)
-            if os.path.exists(path):
-                os.remove(path)
-
-        self.buckets_count = new_buckets_count
-
-        for key, value in all_items:
-            self.set(key, value)
-
-        self.flush()
-        return len(all_items)
+        self.bucket_cache.clear()
+        self.value_cache.clear()
+        self.bloom_filters.clear()
+        self.appended_records.clear()
+        self.key_index = None
+
+        old_buckets_count = self.buckets_count
+        self.buckets_count = _round_to_power_of_two(new_buckets_count)
+        self.bucket_mask = self.buckets_count - 1
+        self._build_paths()
+
+        # Bucket files are independent, so they are read and written by a thread pool to overlap the I/O
+        with ThreadPoolExecutor() as executor:
+            old_buckets = list(
+                executor.map(self._read_bucket, range(old_buckets_count))
+            )
+
+        items_count = 0
+        changed_buckets = {}
+        moving = defaultdict(dict)
+
+        for bucket_id, bucket in enumerate(old_buckets):
+            items_count += len(bucket)
+
+            staying = {}
+            for key, value in bucket.items():
+                target_id = self._get_bucket_id(key)
+                if target_id == bucket_id:
+                    staying[key] = value
+                else:
+                    moving[target_id][key] = value
+
+            if len(staying) != len(bucket):
+                changed_buckets[bucket_id] = staying
+
+        for target_id, incoming in moving.items():
+            if target_id not in changed_buckets:
+                if target_id < old_buckets_count:
+                    changed_buckets[target_id] = old_buckets[target_id]
+                else:
+                    changed_buckets[target_id] = {}
+            changed_buckets[target_id].update(incoming)
+
+        # Drop buckets that fell out of range and leftovers of earlier, larger layouts
+        for bucket_id in range(self.buckets_count, old_buckets_count):
+            self._remove_bucket_files(bucket_id)
+        for bucket_id in range(old_buckets_count, self.buckets_count):
+            if bucket_id not in changed_buckets:
+                self._remove_bucket_files(bucket_id)
+
+        saved_ids = [i for i in changed_buckets if i < self.buckets_count]
+        with ThreadPoolExecutor() as executor:
+            # Consuming the results re-raises the first write error
+            list(
+                executor.map(
+                    self._save_bucket,
+                    saved_ids,
+                    [changed_buckets[i] for i in saved_ids],
+                )
+            )
+
+        return items_count
@@ -1,19 +1,154 @@
-from fastapi import FastAPI, HTTPException, status, Depends
+import asyncio
+import contextlib
+import logging
+import os
+from contextlib import asynccontextmanager
+from itertools import islice
+from fastapi import FastAPI, HTTPException, Query, status, Depends
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 import uvicorn
 from kvstorage.storage import KVStorage
 from kvstorage.storage import KeyNotFoundError
-from server.models import KVEntry, KVResponse, UserCreate, UserLogin, UserResponse, User
+from server.models import (
+    KVBatchRequest,
+    KVEntry,
+    KVResponse,
+    UserCreate,
+    UserLogin,
+    UserResponse,
+    User,
+)
 from typing import List, Optional
 
+logger = logging.getLogger(__name__)
+
 storage = KVStorage()
+# User records are kept apart from the data, so key listings never have to skip them
+users = KVStorage(os.path.join(storage.storage_name, "users"))
 security = HTTPBasic()
 
+# Set in the users storage once user records left in the data storage were moved, user keys always carry User.USERS_PREFIX
+USERS_MIGRATED_KEY = "__users_migrated__"
+
+# Seconds between fsyncs of the written bucket files, writes made since the last one can be lost on a crash
+SYNC_INTERVAL = float(os.getenv("KVSTORAGE_SYNC_INTERVAL", "0.05"))
+
+# A fresh exception is raised each time, a shared instance would collect tracebacks across requests
+UNAUTHORIZED = {
+    "status_code": status.HTTP_401_UNAUTHORIZED,
+    "detail": "Invalid credentials",
+    "headers": {"WWW-Authenticate": "Basic"},
+}
+
+
+def write_through(method, *args):
+    """Run a storage mutation and flush the storage before returning
+
+    Args:
+        method: Bound method of the storage to call
+        *args: Arguments for the method
+
+    Returns:
+        any: The result of the method
+
+    Note:
+        Handlers run this in the threadpool, so bucket I/O does not block the event loop
+    """
+    result = method(*args)
+    method.__self__.flush()
+    return result
+
+
+def migrate_users() -> None:
+    """Move user records left in the data storage by older versions to the users storage
+
+    Note:
+        Candidates are found in the key listing, which reads the key index files only, and users already in the users storage are not overwritten. The users storage is marked once the migration is done, so later starts skip it
+    """
+    if users.exists(USERS_MIGRATED_KEY):
+        return
+
+    legacy_keys = [k for k in storage.keys() if k.startswith(User.USERS_PREFIX)]
+    if legacy_keys:
+        for key, user_data in storage.get_many(legacy_keys).items():
+            users.set_if_absent(key, user_data)
+        users.flush()
+        storage.delete_many(legacy_keys)
+        storage.flush()
+
+    users.set(USERS_MIGRATED_KEY, True)
+    users.flush()
+
+
+def write_back(kv_storage: KVStorage) -> None:
+    """Flush a storage and sync whatever was written, even if some buckets failed"""
+    try:
+        kv_storage.flush()
+    finally:
+        kv_storage.sync()
+
+
+async def sync_periodically() -> None:
+    """Sync both storages to stable storage every SYNC_INTERVAL seconds
+
+    Note:
+        A failed sync is logged and retried on the next tick, the buckets it did not sync stay marked as unsynced
+    """
+    while True:
+        await asyncio.sleep(SYNC_INTERVAL)
+        for kv_storage in (storage, users):
+            try:
+                await run_in_threadpool(kv_storage.sync)
+            except Exception:
+                logger.exception("Periodic sync of %s failed", kv_storage.storage_name)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Migrate legacy user records on startup, sync written buckets in the background and write back everything when the server stops"""
+    migrate_users()
+    sync_task = asyncio.create_task(sync_periodically())
+    yield
+    sync_task.cancel()
+    # A sync still running in the threadpool must finish before the final write back
+    with contextlib.suppress(asyncio.CancelledError):
+        await sync_task
+    # A failure in the data storage must not keep the users from being written back
+    try:
+        write_back(storage)
+    finally:
+        write_back(users)
+
+
 app = FastAPI(
-    title="KV-Storage", description="Tool to create storages of key-value pairs"
+    title="KV-Storage",
+    description="Tool to create storages of key-value pairs",
+    lifespan=lifespan,
 )
 
 
+def authenticate(username: str, password: str) -> Optional[User]:
+    """Look up a user and check their password
+
+    Args:
+        username: The name of the user
+        password: The password to check
+
+    Returns:
+        Optional[User]: The user if the credentials are valid, None otherwise
+    """
+    try:
+        user_data = users.get(User.storage_key(username))
+    except KeyNotFoundError:
+        return None
+
+    user = User.from_dict(user_data)
+    if not user.verify_password(password):
+        return None
+    return user
+
+
 def get_current_user(credentials: HTTPBasicCredentials = Depends(security)) -> User:
     """Validate user credentials and return user object
 
@@ -26,25 +161,10 @@ def get_current_user(credentials: HTTPBasicCredentials = Depends(security)) -> U
     Raises:
         HTTPException: 401 Unauthorized if credentials are invalid
     """
-    try:
-        user_data = storage.get(User.storage_key(credentials.username))
-        user = User.from_dict(user_data)
-
-        if not user.verify_password(credentials.password):
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Invalid credentials",
-                headers={"WWW-Authenticate": "Basic"},
-            )
-        return user
-    except Exception as e:
-        if "Key not found" in str(e) or isinstance(e, KeyNotFoundError):
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Invalid credentials",
-                headers={"WWW-Authenticate": "Basic"},
-            )
-        raise
+    user = authenticate(credentials.username, credentials.password)
+    if user is None:
+        raise HTTPException(**UNAUTHORIZED)
+    return user
 
 
 def optional_auth(
@@ -67,22 +187,51 @@ async def root():
     return {"message": "Welcome to the KVStorage API"}
 
 
+def _list_page(offset: int, limit: Optional[int]) -> List[KVResponse]:
+    """Build one page of the key listing
+
+    Args:
+        offset: Number of key-value pairs to skip
+        limit: Maximum number of key-value pairs to return (None for all)
+
+    Returns:
+        list[KVResponse]: The key-value pairs of the page, internal keys excluded
+
+    Note:
+        Pairs are streamed from the storage bucket by bucket, so only the requested page is built. User records live in their own storage, internal keys are still skipped in case a record was left behind
+    """
+    pairs = (
+        (k, v) for k, v in storage.iter_items() if not k.startswith(User.USERS_PREFIX)
+    )
+    end = None if limit is None else offset + limit
+    return [
+        KVResponse(key=k, value=v, success=True) for k, v in islice(pairs, offset, end)
+    ]
+
+
 @app.get("/keys", response_model=List[KVResponse])
-async def get_all(user: User = Depends(get_current_user)):
+async def get_all(
+    offset: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1),
+    user: User = Depends(get_current_user),
+):
     """List all keys in the storage
 
+    Args:
+        offset: Number of key-value pairs to skip (default: 0)
+        limit: Maximum number of key-value pairs to return (default: all)
+
     Returns:
-        list[KVResponse]: list of all key-value pairs
+        list[KVResponse]: list of key-value pairs
 
     Requires:
         Authentication via HTTP Basic Auth
+
+    Note:
+        The storage scan reads bucket files, so it runs in the threadpool instead of blocking the event loop
     """
     try:
-        items = storage.items()
-        filtered_items = [
-            (k, v) for k, v in items if not k.startswith(User.USERS_PREFIX)
-        ]
-        return [KVResponse(key=k, value=v, success=True) for k, v in filtered_items]
+        return await run_in_threadpool(_list_page, offset, limit)
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
@@ -113,14 +262,52 @@ async def get(key: str, user: User = Depends(get_current_user)):
             detail="Access to internal keys is forbidden",
         )
     try:
-        value = storage.get(key)
+        value = await run_in_threadpool(storage.get, key)
         entry = KVEntry(key=key, value=value)
         return KVResponse.from_entry(entry)
+    except KeyNotFoundError:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Key not found"
+        ) from None
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
+        )
+
+
+@app.post("/keys/batch", response_model=List[KVResponse])
+async def get_batch(batch: KVBatchRequest, user: User = Depends(get_current_user)):
+    """Retrieve the values of several keys at once
+
+    Args:
+        batch: KVBatchRequest containing the keys to retrieve
+
+    Returns:
+        list[KVResponse]: Key-value pairs of the keys that exist, in request order
+
+    Requires:
+        Authentication via HTTP Basic Auth
+
+    Raises:
+        HTTPException: 403 Forbidden - Attempt to access internal keys
+        HTTPException: 500 Internal Server Error - Server error occurred
+
+    Note:
+        Keys are grouped by bucket, so each bucket is loaded at most once per batch
+    """
+    if any(key.startswith(User.USERS_PREFIX) for key in batch.keys):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Access to internal keys is forbidden",
+        )
+    try:
+        values = await run_in_threadpool(storage.get_many, batch.keys)
+        return [
+            KVResponse(key=key, value=values[key], success=True)
+            for key in dict.fromkeys(batch.keys)
+            if key in values
+        ]
     except Exception as e:
-        if "Key not found" in str(e) or isinstance(e, KeyNotFoundError):
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND, detail="Key not found"
-            )
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
         )
@@ -151,13 +338,15 @@ async def create(entry: KVEntry, user: User = Depends(get_current_user)):
             detail="Creating internal keys is forbidden",
         )
     try:
-        if storage.exists(entry.key):
+        created = await run_in_threadpool(
+            write_through, storage.set_if_absent, entry.key, entry.value
+        )
+        if not created:
             raise HTTPException(
                 status_code=status.HTTP_409_CONFLICT,
                 detail=f"Key '{entry.key}' already exists",
             )
 
-        storage.set(entry.key, entry.value)
         return KVResponse.from_entry(entry)
     except HTTPException:
         raise
@@ -202,12 +391,14 @@ async def update(key: str, entry: KVEntry, user: User = Depends(get_current_user
                 detail="Key in URL must match key in request body",
             )
 
-        if not storage.exists(key):
+        updated = await run_in_threadpool(
+            write_through, storage.set_if_exists, key, entry.value
+        )
+        if not updated:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND, detail=f"Key '{key}' not found"
             )
 
-        storage.set(key, entry.value)
         return KVResponse.from_entry(entry)
     except HTTPException:
         raise
@@ -243,11 +434,11 @@ async def delete(key: str, user: User = Depends(get_current_user)):
             detail="Deleting internal keys is forbidden",
         )
     try:
-        if not storage.exists(key):
+        existed, _ = await run_in_threadpool(write_through, storage.pop, key)
+        if not existed:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND, detail=f"Key '{key}' not found"
             )
-        storage.delete(key)
         return None
     except HTTPException:
         raise
@@ -288,19 +479,19 @@ async def register(user_data: UserCreate):
             )
 
         user_key = User.storage_key(user_data.username)
-
-        if storage.exists(user_key):
-            raise HTTPException(
-                status_code=status.HTTP_409_CONFLICT,
-                detail=f"User '{user_data.username}' already exists",
-            )
-
         user = User(
             username=user_data.username,
             password_hash=User.hash_password(user_data.password),
         )
 
-        storage.set(user_key, user.to_dict())
+        created = await run_in_threadpool(
+            write_through, users.set_if_absent, user_key, user.to_dict()
+        )
+        if not created:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f"User '{user_data.username}' already exists",
+            )
 
         return UserResponse(
             username=user_data.username,
@@ -330,20 +521,10 @@ async def login(user_data: UserLogin):
         HTTPException: 500 Internal Server Error - Server error occurred
     """
     try:
-        user_key = User.storage_key(user_data.username)
-
-        try:
-            stored_user_data = storage.get(user_key)
-            user = User.from_dict(stored_user_data)
-        except Exception as e:
-            if "Key not found" in str(e) or isinstance(e, KeyNotFoundError):
-                raise HTTPException(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    detail="Invalid username or password",
-                )
-            raise
-
-        if not user.verify_password(user_data.password):
+        user = await run_in_threadpool(
+            authenticate, user_data.username, user_data.password
+        )
+        if user is None:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Invalid username or password",
@@ -374,4 +555,11 @@ async def get_current_user_info(user: User = Depends(get_current_user)):
 
 
 if __name__ == "__main__":
-    uvicorn.run("server.main:app", host="localhost", port=2310, reload=True)
+    # uvicorn already uses uvloop and httptools when they are installed (kvstorage[server]).
+    # The server runs a single worker, every process would keep its own bucket cache
+    uvicorn.run(
+        "server.main:app",
+        host="localhost",
+        port=2310,
+        reload=bool(os.getenv("KVSTORAGE_DEV")),
+    )
@@ -1,6 +1,7 @@
 from pydantic import BaseModel
-from typing import Any, Optional
+from typing import Any, List, Optional
 import hashlib
+import hmac
 
 
 class KVEntry(BaseModel):
@@ -12,6 +13,14 @@ class KVEntry(BaseModel):
     model_config = {"extra": "forbid"}
 
 
+class KVBatchRequest(BaseModel):
+    """Model for batch key lookups"""
+
+    keys: List[str]
+
+    model_config = {"extra": "forbid"}
+
+
 class KVResponse(BaseModel):
     """Response model for key-value operations"""
 
@@ -58,19 +67,28 @@ class User:
     """User entity for storage"""
 
     USERS_PREFIX = "__users__:"
+    HASH_SCHEME = "blake2b$"
 
     def __init__(self, username: str, password_hash: str):
         self.username = username
         self.password_hash = password_hash
 
-    @staticmethod
-    def hash_password(password: str) -> str:
-        """Hash password using SHA-256"""
-        return hashlib.sha256(password.encode("utf-8")).hexdigest()
+    @classmethod
+    def hash_password(cls, password: str) -> str:
+        """Hash password using BLAKE2b, prefixed with the name of the scheme"""
+        digest = hashlib.blake2b(password.encode("utf-8"), digest_size=32).hexdigest()
+        return f"{cls.HASH_SCHEME}{digest}"
 
     def verify_password(self, password: str) -> bool:
-        """Verify password against stored hash"""
-        return self.password_hash == self.hash_password(password)
+        """Verify password against stored hash in constant time
+
+        Hashes without a scheme prefix were created with SHA-256 by older versions and are still accepted
+        """
+        if self.password_hash.startswith(self.HASH_SCHEME):
+            expected = self.hash_password(password)
+        else:
+            expected = hashlib.sha256(password.encode("utf-8")).hexdigest()
+        return hmac.compare_digest(self.password_hash, expected)
 
     def to_dict(self) -> dict:
         """Convert user to dictionary for storage"""
@@ -0,0 +1,23 @@
+import hashlib
+import json
+import os
+import pytest
+
+
+def _write_sha256_store(path, pairs, buckets_count=16):
+    """Write pretty-printed bucket files placed by SHA-256, the way versions before the layout file did"""
+    buckets = {}
+    for key, value in pairs:
+        bucket_id = int(hashlib.sha256(key.encode("utf-8")).hexdigest(), 16)
+        buckets.setdefault(bucket_id % buckets_count, {})[key] = value
+
+    for bucket_id, bucket in buckets.items():
+        bucket_path = os.path.join(path, f"bucket_{bucket_id}.kvs")
+        with open(bucket_path, "w", encoding="utf-8") as f:
+            json.dump(bucket, f, ensure_ascii=False, indent=2)
+
+
+@pytest.fixture
+def write_sha256_store():
+    """Provide a writer for storages in the layout used before the layout file"""
+    return _write_sha256_store
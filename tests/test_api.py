@@ -1,32 +1,90 @@
-import tempfile
+import functools
+import hashlib
+import os
 import pytest
+import threading
 import base64
 from unittest.mock import patch
 from fastapi.testclient import TestClient
 
+import server.main
+from kvstorage.storage import KVStorage
+from server.main import app
+from server.models import User
+
 
 @pytest.fixture
-def temp_storage_path():
-    with tempfile.TemporaryDirectory() as tmpdir:
-        yield tmpdir
+def temp_storage_path(tmp_path):
+    return str(tmp_path)
+
+
+def make_storages(path):
+    """Create the data and users storages of the server in a directory"""
+    return KVStorage(path), KVStorage(os.path.join(path, "users"))
+
+
+@pytest.fixture(scope="session")
+def app_client(tmp_path_factory):
+    """Create a test client shared by all tests, so the app starts up only once"""
+    session_storage, session_users = make_storages(
+        str(tmp_path_factory.mktemp("session"))
+    )
+    # Tests do not need durability, keep the background sync from fsyncing their storages
+    with patch("server.main.storage", session_storage), patch(
+        "server.main.users", session_users
+    ), patch("server.main.SYNC_INTERVAL", 3600):
+        with TestClient(app) as test_client:
+            warm_up(test_client)
+            yield test_client
+
+
+def warm_up(test_client):
+    """Hit every route once, so the first test does not pay for the lazy setup of the app"""
+    credentials = {"username": "__warm", "password": "warmpass"}
+    headers = get_auth_header(*credentials.values())
+
+    test_client.get("/")
+    test_client.post("/auth/register", json=credentials)
+    test_client.post("/auth/login", json=credentials)
+    test_client.get("/auth/me", headers=headers)
+    entry = {"key": "__warm", "value": 0}
+    test_client.post("/keys", json=entry, headers=headers)
+    test_client.put("/keys/__warm", json=entry, headers=headers)
+    test_client.get("/keys/__warm", headers=headers)
+    test_client.post("/keys/batch", json={"keys": ["__warm"]}, headers=headers)
+    test_client.get("/keys", headers=headers)
+    test_client.delete("/keys/__warm", headers=headers)
 
 
 @pytest.fixture
-def client(temp_storage_path):
-    """Create a test client with a temporary storage"""
-    from src.kvstorage.storage import KVStorage
+def client(app_client, temp_storage_path):
+    """Point the shared test client at fresh temporary storages"""
+    test_storage, test_users = make_storages(temp_storage_path)
 
-    test_storage = KVStorage(temp_storage_path)
+    with patch("server.main.storage", test_storage), patch(
+        "server.main.users", test_users
+    ):
+        yield app_client, test_storage
 
-    with patch("src.server.main.storage", test_storage):
-        from src.server.main import app
 
-        with TestClient(app) as test_client:
-            yield test_client, test_storage
+@pytest.fixture
+def registered_user(client):
+    """Store a test user directly, without going through /auth/register"""
+    user = User("testuser", User.hash_password("testpass"))
+    server.main.users.set(User.storage_key(user.username), user.to_dict())
+    return "testuser", "testpass"
+
+
+@pytest.fixture
+def auth_client(client, registered_user):
+    """Create a client with authenticated user"""
+    test_client, storage = client
+    return test_client, storage, get_auth_header(*registered_user)
 
 
+@functools.lru_cache(maxsize=16)
 def get_auth_header(username: str, password: str) -> dict:
-    """Create HTTP Basic Auth header"""
+    """Create HTTP Basic Auth header (cached, do not modify the returned dict)"""
     credentials = f"{username}:{password}"
     encoded = base64.b64encode(credentials.encode()).decode()
     return {"Authorization": f"Basic {encoded}"}
@@ -84,14 +142,58 @@ class TestUserRegistration:
         assert "at least 4 characters" in response.json()["detail"]
 
 
-class TestUserLogin:
-    """Test user login endpoint"""
+class TestUserStorage:
+    """Test that user records are kept out of the data storage"""
 
-    def test_login_valid_credentials(self, client):
-        test_client, _ = client
+    def test_register_does_not_touch_data_storage(self, client):
+        test_client, storage = client
         test_client.post(
             "/auth/register", json={"username": "testuser", "password": "testpass"}
         )
+        assert storage.keys() == []
+
+    def test_legacy_users_are_migrated(self, temp_storage_path, write_sha256_store):
+        legacy_hash = hashlib.sha256(b"oldpass").hexdigest()
+        write_sha256_store(
+            temp_storage_path,
+            [
+                (User.storage_key("olduser"), User("olduser", legacy_hash).to_dict()),
+                ("data", "value"),
+            ],
+        )
+        test_storage, test_users = make_storages(temp_storage_path)
+
+        with patch("server.main.storage", test_storage), patch(
+            "server.main.users", test_users
+        ):
+            with TestClient(app) as test_client:
+                response = test_client.get(
+                    "/auth/me", headers=get_auth_header("olduser", "oldpass")
+                )
+                assert response.status_code == 200
+
+        assert test_storage.keys() == ["data"]
+
+    def test_users_are_migrated_once(self, temp_storage_path):
+        test_storage, test_users = make_storages(temp_storage_path)
+
+        with patch("server.main.storage", test_storage), patch(
+            "server.main.users", test_users
+        ):
+            with TestClient(app):
+                pass
+
+            # Later starts must not list the data storage again
+            with patch.object(test_storage, "keys", side_effect=AssertionError):
+                with TestClient(app):
+                    pass
+
+
+class TestUserLogin:
+    """Test user login endpoint"""
+
+    def test_login_valid_credentials(self, client, registered_user):
+        test_client, _ = client
         response = test_client.post(
             "/auth/login", json={"username": "testuser", "password": "testpass"}
         )
@@ -108,25 +210,31 @@ class TestUserLogin:
         )
         assert response.status_code == 401
 
-    def test_login_invalid_password(self, client):
+    def test_login_invalid_password(self, client, registered_user):
         test_client, _ = client
-        test_client.post(
-            "/auth/register", json={"username": "testuser", "password": "testpass"}
-        )
         response = test_client.post(
             "/auth/login", json={"username": "testuser", "password": "wrongpass"}
         )
         assert response.status_code == 401
 
+    def test_login_with_legacy_sha256_hash(self, client):
+        test_client, _ = client
+        legacy_hash = hashlib.sha256(b"oldpass").hexdigest()
+        server.main.users.set(
+            User.storage_key("olduser"), User("olduser", legacy_hash).to_dict()
+        )
+
+        response = test_client.post(
+            "/auth/login", json={"username": "olduser", "password": "oldpass"}
+        )
+        assert response.status_code == 200
+
 
 class TestGetCurrentUser:
     """Test get current user endpoint"""
 
-    def test_get_me_authenticated(self, client):
+    def test_get_me_authenticated(self, client, registered_user):
         test_client, _ = client
-        test_client.post(
-            "/auth/register", json={"username": "testuser", "password": "testpass"}
-        )
         response = test_client.get(
             "/auth/me", headers=get_auth_header("testuser", "testpass")
         )
@@ -151,16 +259,6 @@ class TestGetCurrentUser:
 class TestKeyValueEndpoints:
     """Test key-value CRUD endpoints"""
 
-    @pytest.fixture
-    def auth_client(self, client):
-        """Create a client with authenticated user"""
-        test_client, storage = client
-        test_client.post(
-            "/auth/register", json={"username": "testuser", "password": "testpass"}
-        )
-        headers = get_auth_header("testuser", "testpass")
-        return test_client, storage, headers
-
     def test_create_key_value(self, auth_client):
         test_client, _, headers = auth_client
         response = test_client.post(
@@ -188,6 +286,19 @@ class TestKeyValueEndpoints:
         assert response.status_code == 409
         assert "already exists" in response.json()["detail"]
 
+    def test_create_unencodable_value(self, auth_client):
+        test_client, _, headers = auth_client
+        headers = {**headers, "Content-Type": "application/json"}
+        response = test_client.post(
+            "/keys", content=b'{"key": "bad", "value": "\\ud800"}', headers=headers
+        )
+        assert response.status_code == 400
+
+        response = test_client.post(
+            "/keys", json={"key": "name", "value": "Egor"}, headers=headers
+        )
+        assert response.status_code == 201
+
     def test_get_key_value(self, auth_client):
         test_client, _, headers = auth_client
         test_client.post(
@@ -199,19 +310,24 @@ class TestKeyValueEndpoints:
         assert data["key"] == "name"
         assert data["value"] == "Egor"
 
-    def test_get_nonexistent_key(self, auth_client):
+    @pytest.mark.parametrize(
+        "method, body",
+        [
+            ("GET", None),
+            ("PUT", {"key": "nonexistent", "value": "value"}),
+            ("DELETE", None),
+        ],
+    )
+    def test_nonexistent_key(self, auth_client, method, body):
         test_client, _, headers = auth_client
-        response = test_client.get("/keys/nonexistent", headers=headers)
+        response = test_client.request(
+            method, "/keys/nonexistent", json=body, headers=headers
+        )
         assert response.status_code == 404
 
     def test_get_all_keys(self, auth_client):
-        test_client, _, headers = auth_client
-        test_client.post(
-            "/keys", json={"key": "key1", "value": "value1"}, headers=headers
-        )
-        test_client.post(
-            "/keys", json={"key": "key2", "value": "value2"}, headers=headers
-        )
+        test_client, storage, headers = auth_client
+        storage.set_many([("key1", "value1"), ("key2", "value2")])
 
         response = test_client.get("/keys", headers=headers)
         assert response.status_code == 200
@@ -221,19 +337,53 @@ class TestKeyValueEndpoints:
         assert keys == {"key1", "key2"}
 
     def test_get_all_keys_filters_internal(self, auth_client):
-        test_client, _, headers = auth_client
-        test_client.post(
-            "/keys",
-            json={"key": "public_key", "value": "public_value"},
-            headers=headers,
-        )
+        test_client, storage, headers = auth_client
+        storage.set("public_key", "public_value")
+        # A user record left behind in the data storage must never be listed
+        leftover = User("olduser", User.hash_password("oldpass"))
+        storage.set(User.storage_key("olduser"), leftover.to_dict())
 
         response = test_client.get("/keys", headers=headers)
         assert response.status_code == 200
         data = response.json()
 
-        for item in data:
-            assert not item["key"].startswith("__users__:")
+        assert [item["key"] for item in data] == ["public_key"]
+
+    def test_get_all_keys_paginated(self, auth_client):
+        test_client, storage, headers = auth_client
+        storage.set_many((f"key{i}", i) for i in range(5))
+
+        all_keys = [
+            item["key"] for item in test_client.get("/keys", headers=headers).json()
+        ]
+        response = test_client.get("/keys?offset=1&limit=2", headers=headers)
+        assert response.status_code == 200
+        assert [item["key"] for item in response.json()] == all_keys[1:3]
+
+    def test_get_all_keys_invalid_limit(self, auth_client):
+        test_client, _, headers = auth_client
+        response = test_client.get("/keys?limit=0", headers=headers)
+        assert response.status_code == 422
+
+    def test_get_batch(self, auth_client):
+        test_client, storage, headers = auth_client
+        storage.set_many([("a", 1), ("b", 2)])
+
+        response = test_client.post(
+            "/keys/batch", json={"keys": ["b", "missing", "a"]}, headers=headers
+        )
+        assert response.status_code == 200
+        assert [(item["key"], item["value"]) for item in response.json()] == [
+            ("b", 2),
+            ("a", 1),
+        ]
+
+    def test_get_batch_internal_key_forbidden(self, auth_client):
+        test_client, _, headers = auth_client
+        response = test_client.post(
+            "/keys/batch", json={"keys": ["__users__:testuser"]}, headers=headers
+        )
+        assert response.status_code == 403
 
     def test_update_key_value(self, auth_client):
         test_client, _, headers = auth_client
@@ -249,15 +399,6 @@ class TestKeyValueEndpoints:
         assert data["key"] == "name"
         assert data["value"] == "John"
 
-    def test_update_nonexistent_key(self, auth_client):
-        test_client, _, headers = auth_client
-        response = test_client.put(
-            "/keys/nonexistent",
-            json={"key": "nonexistent", "value": "value"},
-            headers=headers,
-        )
-        assert response.status_code == 404
-
     def test_update_key_mismatch(self, auth_client):
         test_client, _, headers = auth_client
         test_client.post(
@@ -282,46 +423,50 @@ class TestKeyValueEndpoints:
         response = test_client.get("/keys/name", headers=headers)
         assert response.status_code == 404
 
-    def test_delete_nonexistent_key(self, auth_client):
-        test_client, _, headers = auth_client
-        response = test_client.delete("/keys/nonexistent", headers=headers)
-        assert response.status_code == 404
-
 
 class TestInternalKeyProtection:
     """Test that internal keys are protected"""
 
-    @pytest.fixture
-    def auth_client(self, client):
-        test_client, storage = client
-        test_client.post(
-            "/auth/register", json={"username": "testuser", "password": "testpass"}
-        )
-        headers = get_auth_header("testuser", "testpass")
-        return test_client, storage, headers
-
-    def test_cannot_create_internal_key(self, auth_client):
+    @pytest.mark.parametrize(
+        "method, path, body",
+        [
+            ("POST", "/keys", {"key": "__users__:hacker", "value": "evil"}),
+            ("GET", "/keys/__users__:testuser", None),
+            (
+                "PUT",
+                "/keys/__users__:testuser",
+                {"key": "__users__:testuser", "value": "hacked"},
+            ),
+            ("DELETE", "/keys/__users__:testuser", None),
+        ],
+    )
+    def test_internal_key_forbidden(self, auth_client, method, path, body):
         test_client, _, headers = auth_client
-        response = test_client.post(
-            "/keys", json={"key": "__users__:hacker", "value": "evil"}, headers=headers
-        )
+        response = test_client.request(method, path, json=body, headers=headers)
         assert response.status_code == 403
 
-    def test_cannot_get_internal_key(self, auth_client):
-        test_client, _, headers = auth_client
-        response = test_client.get("/keys/__users__:testuser", headers=headers)
-        assert response.status_code == 403
 
-    def test_cannot_update_internal_key(self, auth_client):
-        test_client, _, headers = auth_client
-        response = test_client.put(
-            "/keys/__users__:testuser",
-            json={"key": "__users__:testuser", "value": "hacked"},
-            headers=headers,
-        )
-        assert response.status_code == 403
+class TestBackgroundSync:
+    """Test the periodic sync of the storages"""
 
-    def test_cannot_delete_internal_key(self, auth_client):
-        test_client, _, headers = auth_client
-        response = test_client.delete("/keys/__users__:testuser", headers=headers)
-        assert response.status_code == 403
+    def test_failed_sync_does_not_stop_the_loop(self, temp_storage_path):
+        test_storage, test_users = make_storages(temp_storage_path)
+        synced = threading.Event()
+        calls = []
+
+        def flaky_sync():
+            calls.append(len(calls))
+            if len(calls) == 1:
+                raise OSError("No space left on device")
+            synced.set()
+
+        with patch("server.main.storage", test_storage), patch(
+            "server.main.users", test_users
+        ), patch("server.main.SYNC_INTERVAL", 0.01), patch.object(
+            test_storage, "sync", side_effect=flaky_sync
+        ):
+            with TestClient(app):
+                assert synced.wait(5)
+
+        # The final write back syncs once more after the loop was stopped
+        assert len(calls) >= 3
@@ -1,16 +1,21 @@
-import tempfile
 import pytest
 from argparse import Namespace
 from src.kvstorage.storage import KVStorage, KeyNotFoundError
 from src.kvstorage.requests.set_request import SetRequest
 from src.kvstorage.requests.get_request import GetRequest
 from src.kvstorage.requests.delete_request import DeleteRequest
+from kvstorage.cli import main
+
+
+@pytest.fixture(scope="module")
+def shared_storage(tmp_path_factory):
+    return KVStorage(str(tmp_path_factory.mktemp("cli")))
 
 
 @pytest.fixture
-def temp_storage():
-    with tempfile.TemporaryDirectory() as tmpdir:
-        yield KVStorage(tmpdir)
+def temp_storage(shared_storage):
+    yield shared_storage
+    shared_storage.clear()
 
 
 class TestSetRequest:
@@ -150,6 +155,16 @@ class TestDeleteRequest:
         captured = capsys.readouterr()
         assert "'name' was deleted" in captured.out
 
+    def test_delete_duplicate_key_reported_once(self, temp_storage, capsys):
+        temp_storage.set("name", "Egor")
+
+        args = Namespace(items=["name", "name"], verbose=True)
+        request = DeleteRequest(args, temp_storage)
+        request.execute()
+
+        captured = capsys.readouterr()
+        assert captured.out == "'name' was deleted\n"
+
     def test_delete_nonexistent_key(self, temp_storage, capsys):
         args = Namespace(items=["nonexistent"], verbose=True)
         request = DeleteRequest(args, temp_storage)
@@ -162,3 +177,23 @@ class TestDeleteRequest:
         args = Namespace(items=[], verbose=False)
         with pytest.raises(ValueError, match="at least one key is required"):
             DeleteRequest(args, temp_storage)
+
+
+class TestMain:
+    """Test the CLI entry point in-process"""
+
+    def test_set_get_delete(self, tmp_path, capsys):
+        storage_path = str(tmp_path)
+        main([storage_path, "set", "name=Egor"])
+        main([storage_path, "get", "name", "-v"])
+        assert "name = Egor" in capsys.readouterr().out
+
+        main([storage_path, "delete", "name"])
+        main([storage_path, "get", "name", "-v"])
+        assert "'name' not found in storage" in capsys.readouterr().out
+
+    def test_special_characters(self, tmp_path, capsys):
+        storage_path = str(tmp_path)
+        main([storage_path, "set", "key速=!@#$%^&*()"])
+        main([storage_path, "get", "key速", "-v"])
+        assert "key速 = !@#$%^&*()" in capsys.readouterr().out
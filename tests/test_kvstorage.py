@@ -1,13 +1,14 @@
-import tempfile
+import math
 import os
+import threading
 import pytest
-from src.kvstorage.storage import KVStorage, KeyNotFoundError
+from src.kvstorage.storage import KVStorage, KeyNotFoundError, CorruptedBucketError
+from src.kvstorage.bloom import BloomFilter
 
 
 @pytest.fixture
-def temp_storage():
-    with tempfile.TemporaryDirectory() as tmpdir:
-        yield tmpdir
+def temp_storage(tmp_path):
+    return str(tmp_path)
 
 
 @pytest.fixture
@@ -15,6 +16,11 @@ def storage(temp_storage):
     return KVStorage(temp_storage)
 
 
+@pytest.fixture(scope="module")
+def shared_storage(tmp_path_factory):
+    return KVStorage(str(tmp_path_factory.mktemp("shared")))
+
+
 class TestKVStorageInit:
     """Test KVStorage initialization"""
 
@@ -39,10 +45,19 @@ class TestKVStorageInit:
         with pytest.raises(ValueError, match="Invalid buckets count"):
             KVStorage(temp_storage, buckets_count=-1)
 
+    def test_init_rounds_buckets_count_to_power_of_two(self, temp_storage):
+        storage = KVStorage(temp_storage, buckets_count=10)
+        assert storage.buckets_count == 16
+        assert storage.bucket_mask == 15
+
     def test_init_invalid_max_cached_buckets(self, temp_storage):
         with pytest.raises(ValueError, match="Invalid max cached buckets count"):
             KVStorage(temp_storage, max_cached_buckets=0)
 
+    def test_init_invalid_value_cache_size(self, temp_storage):
+        with pytest.raises(ValueError, match="Invalid value cache size"):
+            KVStorage(temp_storage, value_cache_size=-1)
+
     def test_init_existing_file_not_directory(self, temp_storage):
         file_path = os.path.join(temp_storage, "not_a_directory")
         with open(file_path, "w") as f:
@@ -90,6 +105,31 @@ class TestKVStorageBasicOperations:
         value = storage.delete("nonexistent")
         assert value is None
 
+    def test_delete_nonexistent_key_does_not_dirty_bucket(self, storage):
+        storage.delete("nonexistent")
+        assert storage.dirty_buckets == set()
+
+    def test_pop_existing_key(self, storage):
+        storage.set("key", None)
+        assert storage.pop("key") == (True, None)
+        assert storage.exists("key") is False
+
+    def test_pop_nonexistent_key(self, storage):
+        assert storage.pop("nonexistent") == (False, None)
+
+    def test_set_if_absent(self, storage):
+        assert storage.set_if_absent("key", "first") is True
+        assert storage.set_if_absent("key", "second") is False
+        assert storage.get("key") == "first"
+
+    def test_set_if_exists(self, storage):
+        assert storage.set_if_exists("key", "first") is False
+        assert storage.exists("key") is False
+
+        storage.set("key", "first")
+        assert storage.set_if_exists("key", "second") is True
+        assert storage.get("key") == "second"
+
     def test_set_invalid_key_empty(self, storage):
         with pytest.raises(ValueError, match="Invalid key"):
             storage.set("", "value")
@@ -98,10 +138,79 @@ class TestKVStorageBasicOperations:
         with pytest.raises(ValueError, match="Invalid key"):
             storage.set("   ", "value")
 
+    def test_set_invalid_key_not_string(self, storage):
+        with pytest.raises(ValueError, match="Key must be a string"):
+            storage.set(42, "value")
+
+
+class TestKVStorageBatchOperations:
+    """Test set_many/get_many/delete_many"""
+
+    def test_set_many_and_get_many(self, storage):
+        pairs = [(f"key_{i}", f"value_{i}") for i in range(20)]
+        storage.set_many(pairs)
+
+        assert storage.get_many([k for k, _ in pairs]) == dict(pairs)
+
+    def test_set_many_invalid_key_sets_nothing(self, storage):
+        with pytest.raises(ValueError, match="Invalid key"):
+            storage.set_many([("key", "value"), ("  ", "value")])
+        assert storage.keys() == []
+
+    def test_get_many_skips_missing_keys(self, storage):
+        storage.set("key1", "value1")
+        assert storage.get_many(["key1", "missing"]) == {"key1": "value1"}
+
+    def test_delete_many(self, storage):
+        storage.set_many([("key1", "value1"), ("key2", "value2")])
+
+        deleted = storage.delete_many(["key1", "missing"])
+        assert deleted == {"key1": "value1"}
+        assert storage.keys() == ["key2"]
+
+    def test_set_many_loads_each_bucket_once(self, temp_storage):
+        storage = KVStorage(temp_storage, buckets_count=2, max_cached_buckets=1)
+        loads = []
+        original_load = storage._load_bucket
+
+        def counting_load(bucket_id):
+            loads.append(bucket_id)
+            return original_load(bucket_id)
+
+        storage._load_bucket = counting_load
+        storage.set_many([(f"key_{i}", i) for i in range(20)])
+        assert sorted(loads) == [0, 1]
+
+    def test_batch_visits_cached_buckets_first(self, temp_storage):
+        storage = KVStorage(temp_storage, buckets_count=2, max_cached_buckets=1)
+        keys = [f"key_{i}" for i in range(20)]
+
+        # Cache the bucket that the first key of the batch does not belong to
+        cached_id = 1 - storage._get_bucket_id(keys[0])
+        storage._load_bucket(cached_id)
+
+        misses = []
+        original_load = storage._load_bucket
+
+        def counting_load(bucket_id):
+            if bucket_id not in storage.bucket_cache:
+                misses.append(bucket_id)
+            return original_load(bucket_id)
+
+        storage._load_bucket = counting_load
+        storage.set_many([(key, "value") for key in keys])
+        assert misses == [1 - cached_id]
+
 
 class TestKVStorageDataTypes:
     """Test storage with different data types"""
 
+    @pytest.fixture
+    def storage(self, shared_storage):
+        """Reuse one storage, so these tests measure encoding rather than storage setup"""
+        yield shared_storage
+        shared_storage.clear()
+
     def test_store_string(self, storage):
         storage.set("key", "string value")
         assert storage.get("key") == "string value"
@@ -133,6 +242,35 @@ class TestKVStorageDataTypes:
         storage.set("key", data)
         assert storage.get("key") == data
 
+    def test_store_big_integer(self, storage):
+        storage.set("key", 2**70 + 1)
+        storage.set("nested", {"n": 10**30})
+        storage.flush()
+
+        reopened = KVStorage(storage.storage_name)
+        assert reopened.get("key") == 2**70 + 1
+        assert reopened.get("nested") == {"n": 10**30}
+
+    def test_store_nan(self, storage):
+        storage.set("key", float("nan"))
+        storage.set("nested", {"n": [float("nan")], "other": None})
+        storage.flush()
+
+        reopened = KVStorage(storage.storage_name)
+        assert math.isnan(reopened.get("key"))
+        nested = reopened.get("nested")
+        assert math.isnan(nested["n"][0])
+        assert nested["other"] is None
+
+    def test_store_infinity(self, storage):
+        storage.set("positive", float("inf"))
+        storage.set("negative", [float("-inf")])
+        storage.flush()
+
+        reopened = KVStorage(storage.storage_name)
+        assert reopened.get("positive") == float("inf")
+        assert reopened.get("negative") == [float("-inf")]
+
     def test_store_unicode(self, storage):
         storage.set("emoji", "🔑📦")
         storage.set("russian", "Привет")
@@ -167,6 +305,27 @@ class TestKVStorageKeysMethods:
         assert ("key1", "value1") in items
         assert ("key2", "value2") in items
 
+    def test_iter_items_matches_items(self, storage):
+        storage.set_many([(f"key_{i}", i) for i in range(20)])
+        storage.flush()
+        assert list(storage.iter_items()) == storage.items()
+
+    def test_iter_items_reads_buckets_lazily(self, storage):
+        storage.set_many([(f"key_{i}", i) for i in range(20)])
+        storage.flush()
+        storage.bucket_cache.clear()
+
+        read = []
+        original_read = storage._read_bucket
+
+        def recording_read(bucket_id):
+            read.append(bucket_id)
+            return original_read(bucket_id)
+
+        storage._read_bucket = recording_read
+        next(storage.iter_items())
+        assert len(read) < storage.buckets_count
+
     def test_exists_true(self, storage):
         storage.set("key", "value")
         assert storage.exists("key") is True
@@ -174,6 +333,17 @@ class TestKVStorageKeysMethods:
     def test_exists_false(self, storage):
         assert storage.exists("nonexistent") is False
 
+    def test_clear(self, temp_storage):
+        storage = KVStorage(temp_storage)
+        storage.set_many([(f"key_{i}", i) for i in range(20)])
+        storage.flush()
+        storage.get("key_0")
+
+        storage.clear()
+        assert storage.keys() == []
+        assert storage.exists("key_0") is False
+        assert KVStorage(temp_storage).items() == []
+
     def test_exists_after_delete(self, storage):
         storage.set("key", "value")
         assert storage.exists("key") is True
@@ -181,6 +351,123 @@ class TestKVStorageKeysMethods:
         assert storage.exists("key") is False
 
 
+class TestKVStorageKeyIndex:
+    """Test listing keys from the per-bucket key index files"""
+
+    def test_keys_read_from_index(self, temp_storage):
+        storage1 = KVStorage(temp_storage)
+        storage1.set_many([(f"key_{i}", f"value_{i}") for i in range(10)])
+        storage1.flush()
+
+        storage2 = KVStorage(temp_storage)
+        storage2._read_bucket = None  # bucket files must not be parsed
+        assert sorted(storage2.keys()) == sorted(f"key_{i}" for i in range(10))
+        assert storage2.bucket_cache == {}
+
+    def test_stale_index_is_ignored(self, temp_storage):
+        storage1 = KVStorage(temp_storage)
+        storage1.set("key", "value")
+        storage1.flush()
+
+        # Rewrite the bucket behind the index's back
+        with open(storage1._bucket_path(storage1._get_bucket_id("key")), "w") as f:
+            f.write('{"key":"value","other":"value"}')
+
+        storage2 = KVStorage(temp_storage)
+        assert sorted(storage2.keys()) == ["key", "other"]
+
+    def test_keys_include_unsaved_changes(self, storage):
+        storage.set("key", "value")
+        assert storage.keys() == ["key"]
+
+    def test_keys_answered_from_memory_after_first_call(self, storage):
+        storage.set_many([("a", 1), ("b", 2)])
+        storage.keys()
+        storage._read_index = None  # index files must not be read again
+        storage.set("c", 3)
+        storage.delete("a")
+        storage.delete_many(["b"])
+        assert storage.keys() == ["c"]
+
+    def test_exists_answered_from_key_index(self, temp_storage):
+        storage1 = KVStorage(temp_storage)
+        storage1.set_many([(f"key_{i}", i) for i in range(10)])
+        storage1.flush()
+
+        storage2 = KVStorage(temp_storage)
+        storage2.keys()
+        storage2._read_bucket_log = None  # bucket files must not be parsed
+        assert storage2.exists("key_3") is True
+        assert storage2.exists("missing") is False
+        assert storage2.bucket_cache == {}
+
+    def test_items_do_not_evict_cached_buckets(self, temp_storage):
+        storage = KVStorage(temp_storage, max_cached_buckets=1)
+        storage.set_many([(f"key_{i}", i) for i in range(20)])
+        storage.flush()
+        storage.get("key_0")
+        cached = list(storage.bucket_cache)
+
+        assert len(storage.items()) == 20
+        assert list(storage.bucket_cache) == cached
+
+
+class TestBloomFilter:
+    """Test the per-bucket bloom filters"""
+
+    def test_no_false_negatives(self):
+        keys = [f"key_{i}" for i in range(500)]
+        bloom = BloomFilter.from_keys(keys)
+        assert all(bloom.might_contain(key) for key in keys)
+
+    def test_rejects_most_absent_keys(self):
+        bloom = BloomFilter.from_keys([f"key_{i}" for i in range(500)])
+        false_positives = sum(bloom.might_contain(f"other_{i}") for i in range(1000))
+        assert false_positives < 100
+
+    def test_dict_round_trip(self):
+        bloom = BloomFilter.from_keys(["a", "b"])
+        restored = BloomFilter.from_dict(bloom.to_dict())
+        assert (restored.size, restored.bits) == (bloom.size, bloom.bits)
+
+    def test_stored_bits_are_little_endian_integer(self):
+        bloom = BloomFilter.from_keys(["a"])
+        bits = int(bloom.to_dict()["bits"], 16)
+        assert all(bits >> position & 1 for position in bloom._positions("a"))
+        assert bin(bits).count("1") == len(set(bloom._positions("a")))
+
+    def test_append_updates_bloom_without_rebuild(self, temp_storage, monkeypatch):
+        storage = KVStorage(temp_storage, buckets_count=1)
+        storage.set_many([(f"key_{i}", i) for i in range(10)])
+        storage.flush()
+
+        def fail(keys):
+            raise AssertionError("bloom filter was rebuilt")
+
+        monkeypatch.setattr(BloomFilter, "from_keys", fail)
+        storage.set("new", 1)
+        storage.flush()
+        assert storage.bloom_filters[0].might_contain("new")
+
+    def test_missing_keys_skip_bucket_load(self, temp_storage):
+        storage1 = KVStorage(temp_storage)
+        storage1.set_many([(f"key_{i}", f"value_{i}") for i in range(50)])
+        storage1.flush()
+
+        storage2 = KVStorage(temp_storage)
+        storage2._read_bucket = None  # bucket files must not be parsed
+        assert storage2.exists("missing") is False
+        with pytest.raises(KeyNotFoundError):
+            storage2.get("missing")
+
+    def test_present_keys_after_eviction(self, temp_storage):
+        storage = KVStorage(temp_storage, max_cached_buckets=1)
+        storage.set_many([(f"key_{i}", f"value_{i}") for i in range(50)])
+        storage.flush()
+        for i in range(50):
+            assert storage.exists(f"key_{i}") is True
+
+
 class TestKVStoragePersistence:
     """Test data persistence across storage instances"""
 
@@ -202,6 +489,249 @@ class TestKVStoragePersistence:
         assert storage2.get("key1") == "value1"
         assert storage2.get("key2") == "value2"
 
+    def test_persistence_with_stdlib_json(self, temp_storage, monkeypatch):
+        monkeypatch.setattr("src.kvstorage.storage.orjson", None)
+        monkeypatch.setattr("src.kvstorage.common.orjson", None)
+        storage1 = KVStorage(temp_storage)
+        storage1.set("unicode", "Привет")
+        storage1.flush()
+
+        storage2 = KVStorage(temp_storage)
+        assert storage2.get("unicode") == "Привет"
+
+    def test_save_replaces_bucket_atomically(self, storage):
+        storage.set("key", "value")
+        storage.flush()
+        bucket_path = storage._bucket_path(storage._get_bucket_id("key"))
+        assert os.path.exists(bucket_path)
+        assert not os.path.exists(bucket_path + ".tmp")
+
+    def test_snapshot_is_synced_before_replace(self, storage, monkeypatch):
+        events = []
+        original_replace = os.replace
+
+        def recording_replace(src, dst):
+            events.append(("replace", dst))
+            original_replace(src, dst)
+
+        monkeypatch.setattr(os, "fsync", lambda fd: events.append(("sync", fd)))
+        monkeypatch.setattr(
+            os, "fdatasync", lambda fd: events.append(("sync", fd)), raising=False
+        )
+        monkeypatch.setattr(os, "replace", recording_replace)
+
+        storage.set("key", "value")
+        storage.flush()
+        bucket_path = storage._bucket_path(storage._get_bucket_id("key"))
+        replace_at = events.index(("replace", bucket_path))
+        assert replace_at > 0 and events[replace_at - 1][0] == "sync"
+
+    def test_key_index_is_not_synced(self, storage, monkeypatch):
+        storage.set("key", "value")
+        storage.flush()
+        synced = []
+        monkeypatch.setattr(os, "fsync", synced.append)
+        monkeypatch.setattr(os, "fdatasync", synced.append, raising=False)
+
+        # Rewriting a bucket as a snapshot syncs the bucket file only
+        storage._save_bucket(storage._get_bucket_id("key"))
+        assert len(synced) == 1
+
+    def test_corrupted_bucket_raises(self, temp_storage):
+        storage = KVStorage(temp_storage)
+        with open(storage._bucket_path(storage._get_bucket_id("key")), "w") as f:
+            f.write("{not json")
+        with pytest.raises(CorruptedBucketError):
+            storage.get("key")
+
+    def test_persistence_with_memory_mapped_read(self, temp_storage, monkeypatch):
+        monkeypatch.setattr("src.kvstorage.storage.MMAP_MIN_SIZE", 0)
+        storage1 = KVStorage(temp_storage)
+        storage1.set("key", {"nested": [1, 2, 3]})
+        storage1.flush()
+
+        storage2 = KVStorage(temp_storage)
+        assert storage2.get("key") == {"nested": [1, 2, 3]}
+
+
+class TestKVStorageWriteBack:
+    """Test deferred writes of modified buckets"""
+
+    def test_set_is_deferred_until_flush(self, temp_storage):
+        storage = KVStorage(temp_storage)
+        storage.set("key", "value")
+        bucket_path = storage._bucket_path(storage._get_bucket_id("key"))
+        assert not os.path.exists(bucket_path)
+
+        storage.flush()
+        assert os.path.exists(bucket_path)
+        assert storage.dirty_buckets == set()
+
+    def test_unencodable_value_is_rejected(self, storage):
+        storage.set("ok", "value")
+        for set_value in (storage.set, storage.set_if_absent, storage.set_if_exists):
+            with pytest.raises(ValueError, match="Value cannot be stored"):
+                set_value("ok", "\ud800")
+        with pytest.raises(ValueError, match="Value cannot be stored"):
+            storage.set_many([("other", 1), ("bad", {1, 2})])
+
+        assert storage.keys() == ["ok"]
+        storage.flush()
+        assert storage.dirty_buckets == set()
+
+    def test_flush_writes_other_buckets_when_one_fails(self, temp_storage):
+        storage = KVStorage(temp_storage, buckets_count=2)
+        keys = {storage._get_bucket_id(f"key_{i}"): f"key_{i}" for i in range(10)}
+        storage.set_many((key, key) for key in keys.values())
+
+        original_save = storage._save_bucket
+
+        def failing_save(bucket_id, bucket_content=None):
+            if bucket_id == 0:
+                raise OSError("disk full")
+            original_save(bucket_id, bucket_content)
+
+        storage._save_bucket = failing_save
+        with pytest.raises(OSError, match="disk full"):
+            storage.flush()
+        assert storage.dirty_buckets == {0}
+        assert KVStorage(temp_storage, buckets_count=2).get(keys[1]) == keys[1]
+
+        storage._save_bucket = original_save
+        storage.flush()
+        assert KVStorage(temp_storage, buckets_count=2).get(keys[0]) == keys[0]
+
+    def test_flush_keeps_buckets_cached(self, storage):
+        storage.set("key", "value")
+        storage.flush()
+        assert storage._get_bucket_id("key") in storage.bucket_cache
+
+    def test_eviction_writes_dirty_bucket(self, temp_storage):
+        storage = KVStorage(temp_storage, max_cached_buckets=1)
+        for i in range(10):
+            storage.set(f"key_{i}", f"value_{i}")
+
+        # Every bucket except the cached one has been written on eviction
+        storage2 = KVStorage(temp_storage)
+        cached_id = next(iter(storage.bucket_cache))
+        for i in range(10):
+            if storage._get_bucket_id(f"key_{i}") != cached_id:
+                assert storage2.get(f"key_{i}") == f"value_{i}"
+
+    def test_context_manager_flushes_on_exit(self, temp_storage):
+        with KVStorage(temp_storage) as storage:
+            storage.set("key", "value")
+
+        assert storage.dirty_buckets == set()
+        assert KVStorage(temp_storage).get("key") == "value"
+
+    def test_sync_fsyncs_written_buckets_once(self, storage, monkeypatch):
+        synced = []
+        monkeypatch.setattr(os, "fsync", synced.append)
+        monkeypatch.setattr(os, "fdatasync", synced.append, raising=False)
+
+        storage.set_many([("a", 1), ("b", 2)])
+        storage.flush()
+        synced.clear()  # snapshots are synced before they replace the old file
+        written = len(storage.unsynced_buckets)
+        storage.sync()
+        # Every written bucket file, plus the storage directory on posix
+        assert len(synced) == written + (os.name == "posix")
+        assert storage.unsynced_buckets == set()
+
+        synced.clear()
+        storage.sync()
+        assert synced == []
+
+
+class TestKVStorageAppendLog:
+    """Test the append-only bucket log"""
+
+    def test_changes_are_appended(self, temp_storage):
+        storage1 = KVStorage(temp_storage, buckets_count=1)
+        storage1.set_many([("a", 1), ("b", 2)])
+        storage1.flush()
+        bucket_path = storage1._bucket_path(0)
+        snapshot_size = os.path.getsize(bucket_path)
+
+        storage1.set("a", 10)
+        storage1.delete("b")
+        storage1.flush()
+        with open(bucket_path, "rb") as f:
+            assert f.read().count(b"\n") == 2
+        assert os.path.getsize(bucket_path) > snapshot_size
+
+        storage2 = KVStorage(temp_storage, buckets_count=1)
+        assert storage2.items() == [("a", 10)]
+        assert storage2.keys() == ["a"]
+
+    def test_log_is_compacted(self, temp_storage):
+        storage1 = KVStorage(temp_storage, buckets_count=1)
+        for i in range(200):
+            storage1.set("key", i)
+            storage1.flush()
+
+        with open(storage1._bucket_path(0), "rb") as f:
+            assert f.read().count(b"\n") <= 64
+
+        storage2 = KVStorage(temp_storage, buckets_count=1)
+        assert storage2.get("key") == 199
+
+    def test_torn_record_is_ignored(self, temp_storage):
+        storage1 = KVStorage(temp_storage, buckets_count=1)
+        storage1.set("key", "value")
+        storage1.flush()
+        with open(storage1._bucket_path(0), "ab") as f:
+            f.write(b'\n["key","unfin')
+
+        storage2 = KVStorage(temp_storage, buckets_count=1)
+        assert storage2.get("key") == "value"
+
+    def test_write_after_torn_record(self, temp_storage):
+        storage1 = KVStorage(temp_storage, buckets_count=1)
+        storage1.set("a", 1)
+        storage1.flush()
+        storage1.set("b", 2)
+        storage1.flush()
+        with open(storage1._bucket_path(0), "ab") as f:
+            f.write(b'\n["c",12')
+
+        storage2 = KVStorage(temp_storage, buckets_count=1)
+        storage2.set("d", 4)
+        storage2.flush()
+
+        storage3 = KVStorage(temp_storage, buckets_count=1)
+        assert sorted(storage3.items()) == [("a", 1), ("b", 2), ("d", 4)]
+
+    def test_append_keeps_key_index_file(self, temp_storage):
+        storage1 = KVStorage(temp_storage, buckets_count=1)
+        storage1.set_many([("a", 1), ("b", 2)])
+        storage1.flush()
+        with open(storage1._keys_path(0), "rb") as f:
+            index = f.read()
+
+        storage1.set("c", 3)
+        storage1.delete("a")
+        storage1.flush()
+        with open(storage1._keys_path(0), "rb") as f:
+            assert f.read() == index
+
+        storage2 = KVStorage(temp_storage, buckets_count=1)
+        storage2._read_bucket = None  # bucket files must not be parsed
+        assert sorted(storage2.keys()) == ["b", "c"]
+        assert storage2._might_contain(0, "c") is True
+
+    def test_legacy_pretty_printed_bucket(self, temp_storage):
+        storage1 = KVStorage(temp_storage, buckets_count=1)
+        with open(storage1._bucket_path(0), "w") as f:
+            f.write('{\n  "key": "value"\n}')
+
+        storage1.set("other", "value")
+        storage1.flush()
+
+        storage2 = KVStorage(temp_storage, buckets_count=1)
+        assert sorted(storage2.items()) == [("key", "value"), ("other", "value")]
+
 
 class TestKVStorageCaching:
     """Test bucket caching behavior"""
@@ -215,6 +745,121 @@ class TestKVStorageCaching:
         for i in range(20):
             assert storage.get(f"key_{i}") == f"value_{i}"
 
+    def test_least_recently_used_bucket_is_evicted(self, temp_storage):
+        storage = KVStorage(temp_storage, buckets_count=4, max_cached_buckets=2)
+
+        storage._load_bucket(0)
+        storage._load_bucket(1)
+        storage._load_bucket(1)
+        storage._load_bucket(0)
+        storage._load_bucket(2)
+
+        assert list(storage.bucket_cache) == [0, 2]
+
+
+class TestKVStorageThreadSafety:
+    """Test concurrent access from multiple threads"""
+
+    def test_concurrent_sets(self, temp_storage):
+        storage = KVStorage(temp_storage, max_cached_buckets=1)
+
+        def worker(n):
+            for i in range(50):
+                storage.set(f"key_{n}_{i}", i)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(storage.keys()) == 200
+
+
+class TestKVStorageHashing:
+    """Test key to bucket assignment"""
+
+    def test_bucket_id_is_stable(self, temp_storage):
+        storage1 = KVStorage(temp_storage)
+        storage2 = KVStorage(temp_storage)
+        assert storage1._get_bucket_id("name") == storage2._get_bucket_id("name")
+
+    def test_keys_spread_across_buckets(self, storage):
+        bucket_ids = {storage._get_bucket_id(f"key_{i}") for i in range(1000)}
+        assert bucket_ids == set(range(storage.buckets_count))
+
+
+class TestKVStorageLayout:
+    """Test migration of storages written with an older bucket layout"""
+
+    def test_sha256_store_is_migrated(self, temp_storage, write_sha256_store):
+        pairs = [(f"k{i}", i) for i in range(20)]
+        write_sha256_store(temp_storage, pairs)
+
+        storage = KVStorage(temp_storage)
+        assert all(storage.get(key) == value for key, value in pairs)
+        assert sorted(storage.keys()) == sorted(key for key, _ in pairs)
+        assert os.path.exists(os.path.join(temp_storage, "layout.json"))
+
+        assert sorted(KVStorage(temp_storage).items()) == sorted(pairs)
+
+    def test_sha256_store_with_other_bucket_count(
+        self, temp_storage, write_sha256_store
+    ):
+        pairs = [(f"k{i}", i) for i in range(50)]
+        write_sha256_store(temp_storage, pairs, buckets_count=20)
+
+        storage = KVStorage(temp_storage, buckets_count=4)
+        assert all(storage.get(key) == value for key, value in pairs)
+        assert not os.path.exists(os.path.join(temp_storage, "bucket_4.kvs"))
+
+    def test_current_store_is_not_migrated(self, temp_storage, monkeypatch):
+        storage1 = KVStorage(temp_storage)
+        storage1.set("key", "value")
+        storage1.flush()
+
+        def fail(self, new_buckets_count):
+            raise AssertionError("storage was migrated again")
+
+        monkeypatch.setattr(KVStorage, "rebalance", fail)
+        assert KVStorage(temp_storage).get("key") == "value"
+
+    def test_empty_directory_stays_empty(self, temp_storage):
+        KVStorage(temp_storage)
+        assert os.listdir(temp_storage) == []
+
+
+class TestKVStorageValueCache:
+    """Test the hot-key value cache"""
+
+    def test_get_populates_value_cache(self, storage):
+        storage.set("key", "value")
+        assert storage.get("key") == "value"
+        assert storage.value_cache["key"] == "value"
+
+    def test_value_cache_is_bounded(self, temp_storage):
+        storage = KVStorage(temp_storage, value_cache_size=2)
+        for i in range(5):
+            storage.set(f"key_{i}", f"value_{i}")
+            storage.get(f"key_{i}")
+        assert list(storage.value_cache) == ["key_3", "key_4"]
+
+    def test_value_cache_disabled(self, temp_storage):
+        storage = KVStorage(temp_storage, value_cache_size=0)
+        storage.set("key", "value")
+        assert storage.get("key") == "value"
+        assert len(storage.value_cache) == 0
+
+    def test_set_and_delete_invalidate_value_cache(self, storage):
+        storage.set("key", "old")
+        storage.get("key")
+        storage.set("key", "new")
+        assert storage.get("key") == "new"
+
+        storage.delete("key")
+        with pytest.raises(KeyNotFoundError):
+            storage.get("key")
+
 
 class TestKVStorageRebalance:
     """Test bucket rebalancing"""
@@ -251,6 +896,39 @@ class TestKVStorageRebalance:
         assert count == 0
         assert storage.buckets_count == 8
 
+    def test_rebalance_rounds_to_power_of_two(self, temp_storage):
+        storage = KVStorage(temp_storage, buckets_count=4)
+        storage.set("key", "value")
+
+        storage.rebalance(5)
+        assert storage.buckets_count == 8
+        assert storage.get("key") == "value"
+
+    def test_rebalance_rewrites_only_changed_buckets(self, temp_storage):
+        storage = KVStorage(temp_storage, buckets_count=4)
+        storage.set_many([(f"key_{i}", f"value_{i}") for i in range(20)])
+        storage.flush()
+
+        saved = []
+        original_save = storage._save_bucket
+
+        def recording_save(bucket_id, bucket_content=None):
+            saved.append(bucket_id)
+            original_save(bucket_id, bucket_content)
+
+        storage._save_bucket = recording_save
+        assert storage.rebalance(4) == 20
+        assert saved == []
+
+    def test_rebalance_moves_misplaced_keys(self, temp_storage):
+        storage = KVStorage(temp_storage, buckets_count=4)
+        wrong_id = (storage._get_bucket_id("key") + 1) % 4
+        storage._save_bucket(wrong_id, {"key": "value"})
+
+        assert storage.rebalance(4) == 1
+        assert storage.get("key") == "value"
+        assert storage._read_bucket(wrong_id) == {}
+
     def test_rebalance_invalid_count(self, temp_storage):
         storage = KVStorage(temp_storage)
         with pytest.raises(ValueError, match="Invalid buckets count"):
@@ -0,0 +1,161 @@
+import inspect
+import pytest
+from src.kvstorage.sqlite_storage import SQLiteKVStorage
+from src.kvstorage.storage import KVStorage, KeyNotFoundError
+
+
+@pytest.fixture
+def temp_storage(tmp_path):
+    return str(tmp_path)
+
+
+@pytest.fixture
+def storage(temp_storage):
+    storage = SQLiteKVStorage(temp_storage)
+    yield storage
+    storage.close()
+
+
+class TestSQLiteKVStorageOperations:
+    """Test SQLiteKVStorage basic operations"""
+
+    def test_set_and_get(self, storage):
+        storage.set("key", {"nested": [1, 2, 3]})
+        assert storage.get("key") == {"nested": [1, 2, 3]}
+
+    def test_get_nonexistent_key(self, storage):
+        with pytest.raises(KeyNotFoundError):
+            storage.get("nonexistent")
+
+    def test_set_invalid_key(self, storage):
+        with pytest.raises(ValueError, match="Invalid key"):
+            storage.set("   ", "value")
+
+    def test_delete(self, storage):
+        storage.set("key", "value")
+        assert storage.delete("key") == "value"
+        assert storage.delete("key") is None
+        assert storage.exists("key") is False
+
+    def test_set_if_absent(self, storage):
+        assert storage.set_if_absent("key", "first") is True
+        assert storage.set_if_absent("key", "second") is False
+        assert storage.get("key") == "first"
+
+    def test_set_if_exists(self, storage):
+        assert storage.set_if_exists("key", "first") is False
+        storage.set("key", "first")
+        assert storage.set_if_exists("key", "second") is True
+        assert storage.get("key") == "second"
+
+    def test_batch_operations(self, storage):
+        storage.set_many([("a", 1), ("b", 2)])
+        assert storage.get_many(["a", "b", "missing"]) == {"a": 1, "b": 2}
+        assert storage.delete_many(["a", "missing"]) == {"a": 1}
+        assert storage.keys() == ["b"]
+        assert storage.items() == [("b", 2)]
+
+    def test_clear(self, storage):
+        storage.set_many([("a", 1), ("b", 2)])
+        storage.clear()
+        assert storage.keys() == []
+
+
+class TestSQLiteKVStoragePersistence:
+    """Test SQLiteKVStorage persistence"""
+
+    def test_flushed_data_persists(self, temp_storage):
+        storage = SQLiteKVStorage(temp_storage)
+        storage.set("key", "value")
+        storage.flush()
+
+        other = SQLiteKVStorage(temp_storage)
+        assert other.get("key") == "value"
+
+        other.close()
+        storage.close()
+
+
+@pytest.fixture(params=[KVStorage, SQLiteKVStorage])
+def any_storage(request, temp_storage):
+    """Create a storage of each backend, so the same test covers both"""
+    with request.param(temp_storage) as storage:
+        yield storage
+
+
+class TestStorageInterface:
+    """Test that both backends behave the same through the shared interface"""
+
+    def test_public_methods_match(self):
+        def public_methods(cls):
+            return {
+                name
+                for name, _ in inspect.getmembers(cls, inspect.isfunction)
+                if not name.startswith("_")
+            }
+
+        # close() only exists for the database connection
+        assert public_methods(KVStorage) <= public_methods(SQLiteKVStorage)
+        assert public_methods(SQLiteKVStorage) - public_methods(KVStorage) == {"close"}
+
+    def test_single_key_operations(self, any_storage):
+        any_storage.set("key", {"nested": [1, 2.5, None, True]})
+        assert any_storage.get("key") == {"nested": [1, 2.5, None, True]}
+        assert any_storage.exists("key") is True
+        assert any_storage.set_if_absent("key", "other") is False
+        assert any_storage.set_if_exists("key", "other") is True
+        assert any_storage.pop("key") == (True, "other")
+        assert any_storage.delete("key") is None
+        with pytest.raises(KeyNotFoundError):
+            any_storage.get("key")
+
+    def test_batch_operations(self, any_storage):
+        any_storage.set_many([("a", 1), ("b", 2), ("c", 3)])
+        assert any_storage.get_many(["a", "c", "missing"]) == {"a": 1, "c": 3}
+        assert any_storage.delete_many(["a", "missing"]) == {"a": 1}
+        assert sorted(any_storage.keys()) == ["b", "c"]
+        assert sorted(any_storage.items()) == [("b", 2), ("c", 3)]
+        assert sorted(any_storage.iter_items()) == [("b", 2), ("c", 3)]
+
+    def test_iter_items_covers_many_pairs(self, any_storage):
+        pairs = [(f"key_{i:05}", i) for i in range(2500)]
+        any_storage.set_many(pairs)
+        assert sorted(any_storage.iter_items()) == pairs
+
+    @pytest.mark.parametrize(
+        "method", ["set", "set_if_absent", "set_if_exists", "set_many"]
+    )
+    def test_unencodable_value_is_rejected(self, any_storage, method):
+        any_storage.set("key", "value")
+        args = ([("key", object())],) if method == "set_many" else ("key", object())
+
+        with pytest.raises(ValueError, match="Value cannot be stored"):
+            getattr(any_storage, method)(*args)
+        assert any_storage.get("key") == "value"
+
+    def test_invalid_key_is_rejected(self, any_storage):
+        with pytest.raises(ValueError, match="Invalid key"):
+            any_storage.set("   ", "value")
+        with pytest.raises(ValueError, match="Key must be a string"):
+            any_storage.set_many([(1, "value")])
+
+    def test_flush_sync_and_reopen(self, any_storage, temp_storage):
+        any_storage.set("key", "value")
+        any_storage.flush()
+        any_storage.sync()
+
+        with type(any_storage)(temp_storage) as reopened:
+            assert reopened.get("key") == "value"
+
+    def test_rebalance_keeps_items(self, any_storage):
+        any_storage.set_many([(f"key_{i}", i) for i in range(50)])
+        assert any_storage.rebalance(32) == 50
+        assert any_storage.get("key_7") == 7
+        with pytest.raises(ValueError, match="Invalid buckets count"):
+            any_storage.rebalance(0)
+
+    def test_clear(self, any_storage):
+        any_storage.set_many([("a", 1), ("b", 2)])
+        any_storage.clear()
+        assert any_storage.keys() == []
+        assert list(any_storage.iter_items()) == []